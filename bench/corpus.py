@@ -0,0 +1,164 @@
+"""Generates a corpus of school circulars as raw emails, with text PDFs, scanned PDFs, .docx files and photos.
+
+.doc files cannot be generated without Word or LibreOffice, so real samples (.pdf, .doc, .docx)
+can be mixed in from a directory with `samples_dir`.
+"""
+import io
+import os
+import random
+from email.message import EmailMessage
+from email.utils import format_datetime, make_msgid
+from datetime import datetime, timedelta, timezone
+
+SUBJECTS = [
+    "Circolare n. {n} - Sciopero del personale docente e ATA",
+    "Circolare n. {n} - Calendario dei consigli di classe",
+    "Circolare n. {n} - Uscita didattica al museo",
+    "Circolare n. {n} - Colloqui scuola-famiglia",
+    "Circolare n. {n} - Assemblea sindacale in orario di servizio",
+    "Circolare n. {n} - Elezioni dei rappresentanti dei genitori",
+]
+
+SENTENCES = [
+    "Si comunica alle famiglie e al personale che le attività didattiche subiranno variazioni di orario.",
+    "I docenti coordinatori sono invitati a verificare le presenze e a segnalare eventuali criticità.",
+    "La partecipazione è subordinata alla consegna dell'autorizzazione firmata da entrambi i genitori.",
+    "Gli incontri si terranno in presenza presso l'aula magna della sede centrale dell'istituto.",
+    "Per ulteriori informazioni è possibile rivolgersi alla segreteria didattica negli orari di apertura.",
+    "Si ricorda che la puntualità è condizione necessaria per il regolare svolgimento delle lezioni.",
+    "Il Dirigente Scolastico ringrazia per la consueta collaborazione e porge cordiali saluti.",
+    "Le classi interessate sono indicate nella tabella allegata alla presente comunicazione.",
+]
+
+
+def paragraphs(rng, count):
+    return ["  ".join(rng.choice(SENTENCES) for _ in range(rng.randint(3, 6))) for _ in range(count)]
+
+
+def text_pdf(rng, title, pages):
+    import fitz
+
+    document = fitz.open()
+    for page_number in range(pages):
+        page = document.new_page()
+        text = f"{title}\n\n" + "\n\n".join(paragraphs(rng, 6)) if page_number == 0 else "\n\n".join(paragraphs(rng, 8))
+        page.insert_textbox(fitz.Rect(56, 56, 540, 790), text, fontsize=11)
+    return document.tobytes()
+
+
+def scanned_pdf(rng, title, pages, dpi=150):
+    """A PDF whose pages are only images of text, like a scan, so every page needs OCR."""
+    import fitz
+    from PIL import Image, ImageDraw, ImageFont
+
+    document = fitz.open()
+    font = ImageFont.load_default(size=dpi // 6)
+    for page_number in range(pages):
+        width, height = int(8.27 * dpi), int(11.69 * dpi)
+        image = Image.new("L", (width, height), 255)
+        draw = ImageDraw.Draw(image)
+        lines = [title, ""] if page_number == 0 else []
+        for paragraph in paragraphs(rng, 6):
+            words = paragraph.split()
+            while words:
+                lines.append(" ".join(words[:10]))
+                words = words[10:]
+            lines.append("")
+        for i, line in enumerate(lines):
+            draw.text((dpi // 2, dpi // 2 + i * dpi // 4), line, fill=0, font=font)
+        # Scanners never feed pages perfectly straight.
+        image = image.rotate(rng.uniform(-1.5, 1.5), fillcolor=255)
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=70)
+        page = document.new_page()
+        page.insert_image(page.rect, stream=buffer.getvalue())
+    return document.tobytes()
+
+
+def photo_jpeg(rng, title, width=3000, height=4000):
+    """A 12 megapixel phone photo of a printed circular: tinted paper, slightly rotated."""
+    from PIL import Image, ImageDraw, ImageFont
+
+    paper = (rng.randint(220, 245), rng.randint(215, 240), rng.randint(200, 230))
+    image = Image.new("RGB", (width, height), paper)
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default(size=width // 75)
+    y = height // 20
+    for line in [title, ""] + paragraphs(rng, 8):
+        words = line.split() or [""]
+        while words and y < height * 0.95:
+            draw.text((width // 20, y), " ".join(words[:9]), fill=(40, 40, 40), font=font)
+            words = words[9:]
+            y += width // 50
+        y += width // 75
+    image = image.rotate(rng.uniform(-4, 4), fillcolor=paper)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def docx_file(rng, title):
+    from docx import Document
+
+    document = Document()
+    document.add_heading(title, level=1)
+    for paragraph in paragraphs(rng, 5):
+        document.add_paragraph(paragraph)
+    table = document.add_table(rows=4, cols=3)
+    for row, cells in enumerate(table.rows):
+        for column, cell in enumerate(cells.cells):
+            cell.text = ["Classe", "Data", "Orario"][column] if row == 0 else f"{row}{'ABC'[column]}"
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+
+def load_samples(samples_dir):
+    samples = []
+    if not samples_dir:
+        return samples
+    for name in sorted(os.listdir(samples_dir)):
+        if name.lower().endswith((".pdf", ".doc", ".docx")):
+            with open(os.path.join(samples_dir, name), "rb") as file:
+                samples.append((name, file.read()))
+    return samples
+
+
+MIME_TYPES = {
+    "pdf": ("application", "pdf"),
+    "doc": ("application", "msword"),
+    "docx": ("application", "vnd.openxmlformats-officedocument.wordprocessingml.document"),
+    "jpg": ("image", "jpeg"),
+}
+
+
+def generate(count, seed=0, samples_dir=None, scanned_ratio=0.25, docx_ratio=0.25, max_pages=3, photo_ratio=0.0):
+    """Yields `count` raw emails. Each carries one or two attachments picked by the given ratios."""
+    rng = random.Random(seed)
+    samples = load_samples(samples_dir)
+    start = datetime(2024, 9, 1, 8, 0, tzinfo=timezone.utc)
+    for n in range(1, count + 1):
+        title = rng.choice(SUBJECTS).format(n=n)
+        message = EmailMessage()
+        message["From"] = "Segreteria <segreteria@istituto.example>"
+        message["To"] = "monitor@istituto.example"
+        message["Subject"] = title
+        message["Date"] = format_datetime(start + timedelta(hours=n))
+        message["Message-ID"] = make_msgid(idstring=f"bench{seed}-{n}", domain="istituto.example")
+        message.set_content("\n\n".join(paragraphs(rng, 2)))
+
+        for i in range(rng.choice([1, 1, 2])):
+            kind = rng.random()
+            if samples and rng.random() < 0.2:
+                filename, data = rng.choice(samples)
+            elif kind < scanned_ratio:
+                filename, data = f"circolare_{n}_{i}_scansione.pdf", scanned_pdf(rng, title, rng.randint(1, max_pages))
+            elif kind < scanned_ratio + docx_ratio:
+                filename, data = f"circolare_{n}_{i}.docx", docx_file(rng, title)
+            elif kind < scanned_ratio + docx_ratio + photo_ratio:
+                filename, data = f"IMG_{n}_{i}.jpg", photo_jpeg(rng, title)
+            else:
+                filename, data = f"circolare_{n}_{i}.pdf", text_pdf(rng, title, rng.randint(1, max_pages))
+            maintype, subtype = MIME_TYPES[filename.rsplit(".", 1)[-1].lower()]
+            message.add_attachment(data, maintype=maintype, subtype=subtype, filename=filename)
+        yield message.as_bytes()
@@ -0,0 +1,200 @@
+"""Minimal IMAP4rev1 server over plain TCP, serving one in-memory INBOX.
+
+It implements just what `EmailMonitor` and `BatchFetcher` use: LOGIN, CAPABILITY, SELECT,
+STATUS, NOOP, UID SEARCH, UID FETCH (BODYSTRUCTURE and BODY.PEEK[...] sections) and
+UID STORE. Any login is accepted.
+"""
+import email
+import email.policy
+import re
+import socketserver
+import threading
+
+
+def quote(value):
+    if value is None:
+        return "NIL"
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def params_list(params):
+    if not params:
+        return "NIL"
+    return "(" + " ".join(f"{quote(key.upper())} {quote(value)}" for key, value in params) + ")"
+
+
+def header_params(part, header="Content-Type"):
+    """Parameters of a header as written in the message, so RFC 2231 values stay encoded."""
+    params = part.get_params(header=header, unquote=False) or []
+    return [(key, value.strip('"')) for key, value in params[1:]]
+
+
+def bodystructure(part):
+    """Builds the BODYSTRUCTURE of a parsed message, in the layout of RFC 3501 7.4.2."""
+    if part.is_multipart():
+        children = "".join(bodystructure(child) for child in part.get_payload())
+        return f"({children} {quote(part.get_content_subtype().upper())} {params_list(header_params(part))} NIL NIL NIL)"
+
+    payload = raw_payload(part)
+    maintype, subtype = part.get_content_maintype(), part.get_content_subtype()
+    encoding = part.get("Content-Transfer-Encoding", "7bit").upper()
+    fields = f"{quote(maintype.upper())} {quote(subtype.upper())} {params_list(header_params(part))} " \
+             f"NIL NIL {quote(encoding)} {len(payload)}"
+    if maintype == "text":
+        lines = payload.count(b"\r\n")
+        fields += f" {lines}"
+    if part.get("Content-Disposition"):
+        kind = part.get_content_disposition()
+        disposition = f"({quote(kind.upper())} {params_list(header_params(part, 'Content-Disposition'))})"
+    else:
+        disposition = "NIL"
+    return f"({fields} NIL {disposition} NIL NIL)"
+
+
+def raw_payload(part):
+    """The still transfer-encoded body of a leaf part, as BODY[section] returns it."""
+    payload = part.get_payload(decode=False)
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8", errors="replace")
+    return payload.replace(b"\r\n", b"\n").replace(b"\n", b"\r\n")
+
+
+def find_section(message, section):
+    part = message
+    for index in section.split("."):
+        if not part.is_multipart():
+            if index == "1":
+                continue
+            return None
+        children = part.get_payload()
+        if int(index) > len(children):
+            return None
+        part = children[int(index) - 1]
+    return part
+
+
+class Mailbox:
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.messages = []
+        self.lock = threading.Lock()
+
+    def add(self, raw):
+        with self.lock:
+            message = email.message_from_bytes(raw, policy=email.policy.compat32)
+            self.messages.append({"uid": len(self.messages) + 1, "raw": raw, "message": message, "seen": False})
+
+    @property
+    def uidnext(self):
+        return len(self.messages) + 1
+
+    def search(self, criteria):
+        criteria = criteria.upper()
+        if criteria.startswith("UID "):
+            low, _, high = criteria[4:].partition(":")
+            low = int(low)
+            high = len(self.messages) if high in ("*", "") else int(high)
+            uids = [entry["uid"] for entry in self.messages if low <= entry["uid"] <= high]
+            # Like real servers, "n:*" matches the last message even when n is beyond it.
+            if not uids and self.messages and high == len(self.messages):
+                uids = [self.messages[-1]["uid"]]
+            return uids
+        if criteria == "UNSEEN":
+            return [entry["uid"] for entry in self.messages if not entry["seen"]]
+        return [entry["uid"] for entry in self.messages]
+
+    def select(self, uid_set):
+        uids = set()
+        for item in uid_set.split(","):
+            low, _, high = item.partition(":")
+            high = high or low
+            high = len(self.messages) if high == "*" else int(high)
+            uids.update(range(int(low), high + 1))
+        return [entry for entry in self.messages if entry["uid"] in uids]
+
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    def send(self, line):
+        self.wfile.write(line if isinstance(line, bytes) else line.encode("utf-8") + b"\r\n")
+
+    def handle(self):
+        mailbox: Mailbox = self.server.mailbox
+        self.send("* OK [CAPABILITY IMAP4rev1] Fake IMAP ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, _, rest = line.decode("utf-8", errors="replace").rstrip("\r\n").partition(" ")
+            command, _, args = rest.partition(" ")
+            command = command.upper()
+            if command == "UID":
+                command, _, args = args.partition(" ")
+                command = "UID " + command.upper()
+
+            if command == "CAPABILITY":
+                self.send("* CAPABILITY IMAP4rev1")
+            elif command in ("SELECT", "EXAMINE"):
+                self.send(f"* {len(mailbox.messages)} EXISTS")
+                self.send(f"* OK [UIDVALIDITY {mailbox.uidvalidity}] UIDs valid")
+                self.send(f"* OK [UIDNEXT {mailbox.uidnext}] Predicted next UID")
+            elif command == "STATUS":
+                name = args.split(" ", 1)[0]
+                self.send(f"* STATUS {name} (UIDVALIDITY {mailbox.uidvalidity} UIDNEXT {mailbox.uidnext})")
+            elif command == "UID SEARCH":
+                criteria = re.sub(r"^CHARSET \S+ ", "", args, flags=re.IGNORECASE)
+                self.send("* SEARCH " + " ".join(str(uid) for uid in mailbox.search(criteria)))
+            elif command == "UID FETCH":
+                uid_set, _, items = args.partition(" ")
+                for entry in mailbox.select(uid_set):
+                    self.fetch(entry, items.strip("()").split())
+            elif command == "UID STORE":
+                uid_set, _, flags = args.partition(" ")
+                for entry in mailbox.select(uid_set):
+                    entry["seen"] = entry["seen"] or "\\SEEN" in flags.upper()
+            elif command == "LOGOUT":
+                self.send("* BYE Logging out")
+                self.send(f"{tag} OK LOGOUT completed")
+                return
+            elif command not in ("LOGIN", "NOOP", "CLOSE"):
+                self.send(f"{tag} BAD Unsupported command {command}")
+                continue
+            self.send(f"{tag} OK {command} completed")
+
+    def fetch(self, entry, items):
+        message = entry["message"]
+        response = f"* {entry['uid']} FETCH (UID {entry['uid']}".encode()
+        for item in items:
+            name = item.upper().replace(".PEEK", "")
+            if name == "BODYSTRUCTURE":
+                response += f" BODYSTRUCTURE {bodystructure(message)}".encode()
+                continue
+            section = re.fullmatch(r"BODY\[(.*)\]", name)
+            if not section:
+                continue
+            section = section.group(1)
+            if section == "HEADER":
+                data = entry["raw"].replace(b"\r\n", b"\n").split(b"\n\n", 1)[0].replace(b"\n", b"\r\n") + b"\r\n\r\n"
+            elif section == "":
+                data = entry["raw"]
+            else:
+                part = find_section(message, section)
+                data = raw_payload(part) if part is not None else b""
+            response += f" BODY[{section}] {{{len(data)}}}\r\n".encode() + data
+        self.send(response + b")\r\n")
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mailbox: Mailbox, host="127.0.0.1", port=0):
+        super().__init__((host, port), IMAPHandler)
+        self.mailbox = mailbox
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
@@ -0,0 +1,74 @@
+"""Stub of the Ollama chat API that answers after a configurable latency."""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class OllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path != "/api/chat":
+            self.reply(404, {"error": f"unknown endpoint {self.path}"})
+            return
+        prompt = request["messages"][-1]["content"]
+        server: FakeOllamaServer = self.server
+        start = time.perf_counter()
+        server.wait(prompt)
+        words = prompt.split()
+        content = "Riassunto: " + " ".join(words[:40])
+        self.reply(200, {
+            "model": request.get("model"),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "message": {"role": "assistant", "content": content},
+            "done": True,
+            "total_duration": int((time.perf_counter() - start) * 1e9),
+            "prompt_eval_count": len(words),
+            "eval_count": len(content.split()),
+        })
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    """`latency` seconds per request plus `per_token` seconds per prompt token, with +/- `jitter`.
+    At most `parallel` requests are served at once, like OLLAMA_NUM_PARALLEL."""
+
+    daemon_threads = True
+
+    def __init__(self, latency=1.0, per_token=0.0, jitter=0.1, parallel=4, host="127.0.0.1", port=0):
+        super().__init__((host, port), OllamaHandler)
+        self.latency = latency
+        self.per_token = per_token
+        self.jitter = jitter
+        self.slots = threading.Semaphore(parallel)
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def wait(self, prompt):
+        with self.lock:
+            self.requests += 1
+        delay = self.latency + self.per_token * len(prompt) / 4
+        delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        with self.slots:
+            time.sleep(max(delay, 0))
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
@@ -0,0 +1,313 @@
+"""End-to-end benchmark: IMAP fetch, attachment extraction and OCR, LLM summaries and SMTP delivery.
+
+Everything runs locally: a fake IMAP server seeded with a generated corpus, a stub Ollama with
+configurable latency and an SMTP sink. Postgres is a throwaway database created on the server
+named by DB_HOST/DB_USER/DB_PASSWORD and dropped afterwards, or a throwaway container with --docker.
+
+    python bench/run.py --emails 50 --llm-latency 2 --output bench/results/baseline.json
+    python bench/run.py --emails 50 --baseline bench/results/baseline.json
+"""
+import argparse
+import functools
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "src"), os.path.dirname(os.path.abspath(__file__))]
+
+import corpus  # noqa: E402
+from fake_imap import FakeIMAPServer, Mailbox  # noqa: E402
+from fake_ollama import FakeOllamaServer  # noqa: E402
+from smtp_sink import SMTPSink  # noqa: E402
+
+STAGES = ("fetch", "extract", "ocr", "llm", "send")
+
+
+class Timings:
+    """Collects per-stage samples in seconds and summarises them as percentiles."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def record(self, stage, seconds):
+        self.samples[stage].append(seconds)
+
+    def wrap(self, obj, name, stage, per_item=None):
+        """Times every call of `obj.name`. `per_item` splits a batch call's time over its items."""
+        method = getattr(obj, name)
+
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = method(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+            items = per_item(args, result) if per_item else 1
+            for _ in range(items):
+                self.record(stage, elapsed / max(items, 1))
+            return result
+
+        setattr(obj, name, timed)
+
+    def wrap_async(self, obj, name, stage):
+        method = getattr(obj, name)
+
+        @functools.wraps(method)
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+
+        setattr(obj, name, timed)
+
+    def wrap_images(self, reader):
+        """Records the OCR time of each image attachment, preparation included."""
+        extract_text = reader.extract_text
+
+        @functools.wraps(extract_text)
+        def timed(detail=None):
+            detail = {} if detail is None else detail
+            text = extract_text(detail)
+            if "ocr_seconds" in detail:
+                self.record("ocr", detail["prepare_seconds"] + detail["ocr_seconds"])
+            return text
+
+        reader.extract_text = timed
+
+    def wrap_pages(self, reader):
+        """Records the OCR time of each page the PDF reader recognises."""
+        extract_pages = reader.extract_pages
+
+        @functools.wraps(extract_pages)
+        def timed(*args, **kwargs):
+            for page in extract_pages(*args, **kwargs):
+                if page["method"] == "ocr" and page["ocr_seconds"] is not None:
+                    self.record("ocr", page["ocr_seconds"])
+                yield page
+
+        reader.extract_pages = timed
+
+    @staticmethod
+    def percentile(values, fraction):
+        ordered = sorted(values)
+        return ordered[min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)]
+
+    def summary(self):
+        return {
+            stage: {
+                "count": len(values),
+                "p50": round(self.percentile(values, 0.5), 4),
+                "p95": round(self.percentile(values, 0.95), 4),
+                "mean": round(sum(values) / len(values), 4),
+                "max": round(max(values), 4),
+                "total": round(sum(values), 3),
+            } if values else {"count": 0}
+            for stage, values in ((stage, self.samples.get(stage, [])) for stage in STAGES)
+        }
+
+
+def start_docker_postgres(image):
+    name = f"bench-postgres-{uuid.uuid4().hex[:8]}"
+    subprocess.run([
+        "docker", "run", "--rm", "-d", "--name", name, "-p", "127.0.0.1::5432",
+        "-e", "POSTGRES_USER=bench", "-e", "POSTGRES_PASSWORD=bench", "-e", "POSTGRES_DB=postgres", image
+    ], check=True, capture_output=True)
+    port = subprocess.run(
+        ["docker", "port", name, "5432/tcp"], check=True, capture_output=True, text=True
+    ).stdout.split(":")[-1].strip()
+    os.environ.update(DB_HOST=f"127.0.0.1:{port}", DB_USER="bench", DB_PASSWORD="bench")
+    return name
+
+
+def wait_for_postgres(url, timeout=60):
+    from sqlalchemy import create_engine, text
+
+    engine = create_engine(url, isolation_level="AUTOCOMMIT")
+    deadline = time.time() + timeout
+    while True:
+        try:
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+            return engine
+        except Exception:
+            if time.time() > deadline:
+                raise
+            time.sleep(1)
+
+
+def server_url():
+    return f"postgresql+psycopg2://{os.getenv('DB_USER', 'user')}:{os.getenv('DB_PASSWORD', 'password')}" \
+           f"@{os.getenv('DB_HOST', 'localhost')}/postgres"
+
+
+def git_version():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=ROOT, check=True, capture_output=True, text=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(result, baseline):
+    print(f"\nCompared with {baseline.get('version')} ({baseline.get('started_at')}):")
+    before, after = baseline["emails_per_minute"], result["emails_per_minute"]
+    print(f"  emails/min  {before:>9.2f} -> {after:>9.2f}  ({(after - before) / before * 100:+.1f}%)")
+    for stage in STAGES:
+        old, new = baseline["stages"].get(stage, {}), result["stages"][stage]
+        for key in ("p50", "p95"):
+            if old.get(key) and new.get(key):
+                change = (new[key] - old[key]) / old[key] * 100
+                print(f"  {stage:<7} {key}  {old[key]:>9.4f} -> {new[key]:>9.4f}s ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--emails", type=int, default=20, help="Emails in the generated corpus")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--samples", help="Directory of real .pdf/.doc/.docx files mixed into the corpus")
+    parser.add_argument("--scanned-ratio", type=float, default=0.25, help="Share of attachments that are scans")
+    parser.add_argument("--docx-ratio", type=float, default=0.25, help="Share of attachments that are .docx")
+    parser.add_argument("--photo-ratio", type=float, default=0.0, help="Share of attachments that are phone photos")
+    parser.add_argument("--max-pages", type=int, default=3)
+    parser.add_argument("--recipients", type=int, default=3)
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="Stub Ollama seconds per request")
+    parser.add_argument("--llm-per-token", type=float, default=0.0, help="Stub Ollama seconds per prompt token")
+    parser.add_argument("--llm-parallel", type=int, default=4, help="Requests the stub Ollama serves at once")
+    parser.add_argument("--docker", action="store_true", help="Run Postgres in a throwaway container")
+    parser.add_argument("--docker-image", default="postgres:16")
+    parser.add_argument("--keep-db", action="store_true", help="Do not drop the benchmark database")
+    parser.add_argument("--output", help="Result file, by default bench/results/<version>-<time>.json")
+    parser.add_argument("--baseline", help="Earlier result file to compare with")
+    args = parser.parse_args()
+    # The benchmark runs from a scratch directory, so resolve the paths first.
+    args.output = os.path.abspath(args.output) if args.output else None
+    args.baseline = os.path.abspath(args.baseline) if args.baseline else None
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(message)s", force=True)
+    container_name = start_docker_postgres(args.docker_image) if args.docker else None
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    admin = None
+    components = None
+    database = f"bench_{uuid.uuid4().hex[:12]}"
+    try:
+        admin = wait_for_postgres(server_url())
+        with admin.connect() as connection:
+            connection.exec_driver_sql(f"CREATE DATABASE {database}")
+
+        started = time.perf_counter()
+        mails = list(corpus.generate(
+            args.emails, args.seed, args.samples, args.scanned_ratio, args.docx_ratio, args.max_pages, args.photo_ratio
+        ))
+        print(f"Generated {len(mails)} emails ({sum(map(len, mails)) / 1e6:.1f} MB) "
+              f"in {time.perf_counter() - started:.1f}s.")
+
+        mailbox = Mailbox()
+        for mail in mails:
+            mailbox.add(mail)
+        imap = FakeIMAPServer(mailbox).start()
+        ollama = FakeOllamaServer(args.llm_latency, args.llm_per_token, parallel=args.llm_parallel).start()
+        smtp = SMTPSink().start()
+
+        os.environ.update(
+            DB_NAME=database,
+            IMAP_SERVER="127.0.0.1", IMAP_PORT=str(imap.port), IMAP_SSL="false", IMAP_IDLE="false",
+            SMTP_SERVER="127.0.0.1", SMTP_PORT=str(smtp.port), SMTP_SSL="false",
+            OLLAMA_HOST=ollama.url, OLLAMA_NUM_PARALLEL=str(args.llm_parallel),
+            EMAIL_ACCOUNT="monitor@istituto.example", PASSWORD="bench",
+            RECIPIENTS=",".join(f"docente{i}@istituto.example" for i in range(1, args.recipients + 1)),
+        )
+        # The attachment store writes relative to the working directory.
+        os.chdir(workdir)
+        from container import Container
+
+        components = Container()
+        components.db_manager.connect()
+        monitor, parser_, dispatcher = components.monitor, components.parser, components.dispatcher
+
+        timings = Timings()
+        timings.wrap(monitor.fetcher, "fetch", "fetch", per_item=lambda call, result: len(result))
+        timings.wrap(parser_, "extract_text", "extract")
+        timings.wrap_pages(parser_.pdf_reader)
+        timings.wrap_images(parser_.image_reader)
+        timings.wrap_async(parser_.operator, "ask_async", "llm")
+        timings.wrap(components.sender, "sendmail", "send")
+
+        phases = {}
+        start = time.perf_counter()
+        monitor.check_mail()
+        phases["ingest"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        processed = parser_.process_queued_emails()
+        phases["parse"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        while dispatcher.dispatch():
+            continue
+        phases["deliver"] = time.perf_counter() - start
+
+        total = sum(phases.values())
+        result = {
+            "version": git_version(),
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+            "emails": len(mails),
+            "processed": processed,
+            "llm_requests": ollama.requests,
+            "smtp_messages": smtp.messages,
+            "smtp_deliveries": smtp.deliveries,
+            "phases_seconds": {phase: round(seconds, 3) for phase, seconds in phases.items()},
+            "total_seconds": round(total, 3),
+            "emails_per_minute": round(len(mails) / total * 60, 2) if total else None,
+            "stages": timings.summary(),
+        }
+
+        print(f"\n{len(mails)} emails in {total:.1f}s: {result['emails_per_minute']} emails/min "
+              f"({', '.join(f'{phase} {seconds:.1f}s' for phase, seconds in phases.items())})")
+        print(f"{'stage':<8}{'count':>7}{'p50':>10}{'p95':>10}{'max':>10}")
+        for stage, stats in result["stages"].items():
+            if stats["count"]:
+                print(f"{stage:<8}{stats['count']:>7}{stats['p50']:>10.4f}{stats['p95']:>10.4f}{stats['max']:>10.4f}")
+
+        output = args.output or os.path.join(
+            ROOT, "bench", "results", f"{result['version'] or 'unknown'}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+        )
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, "w") as file:
+            json.dump(result, file, indent=2)
+        print(f"\nSaved {output}")
+
+        if args.baseline:
+            with open(args.baseline) as file:
+                compare(result, json.load(file))
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+        if components is not None:
+            components.db_manager.engine.dispose()
+        if admin is not None and not args.keep_db:
+            try:
+                from sqlalchemy import text
+
+                with admin.connect() as connection:
+                    connection.execute(text(f"DROP DATABASE IF EXISTS {database} WITH (FORCE)"))
+            except Exception as e:
+                print(f"Could not drop {database}: {e}")
+            admin.dispose()
+        if container_name:
+            subprocess.run(["docker", "rm", "-f", container_name], capture_output=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,43 @@
 import axios from 'axios';
-import type { Log } from '../types.ts';
+import type { Log, LogEvent, LogPage, SearchPage, TimelineEntry } from '../types.ts';
 
 const API_URL = 'http://localhost:8000';
 
-export async function fetchLogs(): Promise<Log[]> {
+// Responses carry an ETag, the browser revalidates them and reuses unchanged pages on a 304.
+export async function fetchLogs(cursor: string | null = null, limit = 50): Promise<LogPage> {
 	const response = await axios.get(`${API_URL}/logs`, {
+		headers: { accept: 'application/json' },
+		params: { limit, ...(cursor ? { cursor } : {}) }
+	});
+	return response.data;
+}
+
+export async function searchLogs(query: string, offset = 0, limit = 20): Promise<SearchPage> {
+	const response = await axios.get(`${API_URL}/search`, {
+		headers: { accept: 'application/json' },
+		params: { q: query, offset, limit }
+	});
+	return response.data;
+}
+
+export async function fetchLog(id: number): Promise<Log> {
+	const response = await axios.get(`${API_URL}/logs/${id}`, {
+		headers: { accept: 'application/json' }
+	});
+	return response.data;
+}
+
+// One stream of change events, the browser reconnects on its own. Returns a function closing it.
+export function subscribeEvents(onEvent: (event: LogEvent) => void): () => void {
+	const source = new EventSource(`${API_URL}/events`);
+	for (const type of ['logged', 'status', 'delivery', 'resync']) {
+		source.addEventListener(type, (message) => onEvent(JSON.parse((message as MessageEvent).data)));
+	}
+	return () => source.close();
+}
+
+export async function fetchTimeline(id: number): Promise<TimelineEntry[]> {
+	const response = await axios.get(`${API_URL}/logs/${id}/timeline`, {
 		headers: { accept: 'application/json' }
 	});
 	return response.data;
@@ -18,3 +18,33 @@ export interface Log {
 	processed: boolean;
 	received_at: string;
 }
+
+export type LogListItem = Omit<Log, 'body' | 'attachments'> & { status: string };
+
+export interface TimelineEntry {
+	stage: 'received' | 'fetched' | 'extract' | 'llm' | 'processed' | 'send';
+	label: string | null;
+	started_at: string;
+	ended_at: string | null;
+	seconds: number | null;
+	size: number | null;
+	detail: Record<string, string | number | boolean> | null;
+}
+
+export type SearchResult = LogListItem & { rank: number; headline: string };
+
+export interface SearchPage {
+	items: SearchResult[];
+	next_offset: number | null;
+}
+
+export type LogEvent =
+	| { type: 'logged'; id: number }
+	| { type: 'status'; id: number; status: string; error?: string }
+	| { type: 'delivery'; id: number; recipient: string; status: string; error?: string }
+	| { type: 'resync' };
+
+export interface LogPage {
+	items: LogListItem[];
+	next_cursor: string | null;
+}
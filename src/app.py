@@ -1,14 +1,19 @@
+import asyncio
+import base64
+import hashlib
+import json
 import logging
-from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from starlette.middleware.cors import CORSMiddleware
 
+from container import Container
 from database import EmailLog
-from monitor import EmailMonitor
-from parser import Parser
-from workers.operator import Operator
-from workers.sender import Sender
+from metrics import BACKLOG, DirectorySize
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 
@@ -20,44 +25,184 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
-monitor = EmailMonitor()
-parser = Parser()
-sender = Sender()
-operator = Operator()
+container = Container()
+# Endpoints use the async manager so slow queries never block the event loop.
+db = container.async_db
+events = container.events
+attachments_size = DirectorySize(container.store.root)
 
 
 @app.on_event("startup")
-def startup_event():
-    executor = ThreadPoolExecutor(max_workers=2)
-    executor.submit(monitor.run)
-    executor.submit(parser.start_periodic_check, 60)
+async def startup_event():
+    container.start(60)
+    events.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await events.close()
+    await db.close()
+
+
+def encode_cursor(log: dict) -> str:
+    value = f"{log['received_at'].isoformat()}|{log['id']}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        received_at, email_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(received_at), int(email_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+
+
+def etag_response(request: Request, content) -> Response:
+    """Serialises the content once and answers 304 when the client already has the same version."""
+    body = json.dumps(jsonable_encoder(content)).encode()
+    etag = f'"{hashlib.sha1(body).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@app.get("/health")
+async def health() -> dict:
+    """Answers as soon as the API is up, reporting which background connections are ready."""
+    return {"status": "ok", **container.health()}
+
+
+@app.get("/metrics")
+async def metrics() -> Response:
+    """Prometheus metrics. Gauges are refreshed here, histograms and counters as the pipeline runs."""
+    backlog = await db.count_backlog()
+    if backlog is not None:
+        for queue, count in backlog.items():
+            BACKLOG.labels(queue=queue).set(count)
+    await asyncio.to_thread(attachments_size.refresh)
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 
 @app.get("/logs")
-async def read_logs() -> list:
-    logs = monitor.db_manager.read_all_email_logs()
-    return [log.to_dict() for log in logs]
+async def read_logs(request: Request, cursor: str | None = None, limit: int = Query(50, ge=1, le=200)) -> Response:
+    """Lists logs newest first without body and attachments. Pass `next_cursor` back to get the next page."""
+    after = decode_cursor(cursor) if cursor else None
+    logs = await db.read_email_log_page(limit + 1, after)
+    next_cursor = encode_cursor(logs[limit - 1]) if len(logs) > limit else None
+    return etag_response(request, {"items": logs[:limit], "next_cursor": next_cursor})
+
+
+@app.get("/search")
+async def search_logs(
+    request: Request,
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=10000)
+) -> Response:
+    """Full-text search over subjects, bodies and summaries, best matches first."""
+    items, more = await db.search_email_logs(q, limit, offset)
+    return etag_response(request, {"items": items, "next_offset": offset + limit if more else None})
+
+
+@app.get("/logs/{email_id}")
+async def read_log(request: Request, email_id: int) -> Response:
+    log: EmailLog = await db.read_email_log(email_id)
+    if not log:
+        raise HTTPException(status_code=404, detail="Log not found.")
+    return etag_response(request, log.to_dict())
+
+
+@app.get("/events")
+async def stream_events(heartbeat_seconds: float = Query(15, gt=0)) -> StreamingResponse:
+    """Server-sent events for new emails, processing status and delivery results.
+    A `resync` event asks the client to reload, it may have missed events."""
+    async def stream():
+        with events.subscribe() as queue:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), heartbeat_seconds)
+                except asyncio.TimeoutError:
+                    # Keeps proxies from closing an idle stream.
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(
+        stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.get("/logs/{email_id}/timeline")
+async def read_log_timeline(request: Request, email_id: int) -> Response:
+    """The stages the email went through, from reception to the last delivery, oldest first."""
+    if not await db.read_email_log(email_id):
+        raise HTTPException(status_code=404, detail="Log not found.")
+    return etag_response(request, await db.read_timeline(email_id))
 
 
 @app.post("/process/{email_id}")
-async def process_email(email_id: int) -> dict:
+async def process_email(email_id: int, force: bool = False) -> dict:
+    """Queues the email for the parser workers and returns a job id to poll on `/jobs/{job_id}`."""
     try:
-        log: EmailLog = monitor.db_manager.read_email_log(email_id)
-        if not log:
+        if not await db.read_email_log(email_id):
             return {"error": "Log not found."}
-        return parser.process_email(log)
+        if not await db.requeue_email_log(email_id, force=force):
+            return {"error": "Email is already being processed."}
+        return {"job_id": f"process:{email_id}", "status": "queued"}
     except Exception as e:
         return {"error": str(e)}
 
 
+@app.get("/stats/llm-cache")
+async def llm_cache_stats() -> dict:
+    return container.llm_cache.stats()
+
+
 @app.post("/forward/{email_id}")
-async def forward_email(email_id: int):
+async def forward_email(email_id: int) -> dict:
+    """Queues the email for every recipient that has not received it yet and returns a job id."""
     try:
-        log: EmailLog = monitor.db_manager.read_email_log(email_id)
-        if not log:
+        if not await db.read_email_log(email_id):
             return {"error": "Log not found."}
-        return sender.send_emails(log)
+        deliveries = await db.enqueue_outbox(email_id, container.sender.recipients)
+        return {
+            "job_id": f"forward:{email_id}",
+            "status": "queued",
+            "deliveries": [delivery.to_dict() for delivery in deliveries]
+        }
     except Exception as e:
         return {"error": str(e)}
+
+
+@app.get("/jobs/{job_id}")
+async def read_job(job_id: str) -> dict:
+    """Reports a job started by `/process` (`process:<email_id>`) or `/forward` (`forward:<email_id>`)."""
+    kind, _, email_id = job_id.partition(":")
+    if kind not in ("process", "forward") or not email_id.isdigit():
+        raise HTTPException(status_code=400, detail="Invalid job id.")
+    if kind == "process":
+        job = await db.read_process_job(int(email_id))
+    else:
+        job = await db.read_forward_job(int(email_id))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return {"job_id": job_id, **job}
+
+
+@app.get("/outbox")
+async def read_outbox(status: str | None = None, email_id: int | None = None, limit: int = 100) -> list:
+    deliveries = await db.read_outbox(status, email_id, limit)
+    return [delivery.to_dict() for delivery in deliveries]
+
+
+@app.post("/outbox/{outbox_id}/retry")
+async def retry_delivery(outbox_id: int) -> dict:
+    delivery = await db.retry_outbox(outbox_id)
+    if not delivery:
+        return {"error": "Delivery not found or not failed."}
+    return delivery.to_dict()
@@ -0,0 +1,218 @@
+import logging
+import os
+
+from sqlalchemy import select as sql_select, update, or_, func, tuple_, text, literal_column
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from database import (
+    EmailLog, EmailTimeline, Outbox, LOG_LIST_COLUMNS, QUEUE_CHANNEL, OUTBOX_CHANNEL, SEARCH_CONFIG, notify_event,
+    enqueue_outbox_statements, outbox_of, STATUS_QUEUED, STATUS_RUNNING, STATUS_DONE, STATUS_FAILED
+)
+
+
+class AsyncDatabaseManager:
+    """Asyncio counterpart of `DatabaseManager` for the API, on asyncpg with an explicitly sized pool.
+    Tables and migrations are still created by the synchronous manager."""
+
+    def __init__(self):
+        db_user = os.getenv("DB_USER", "user")
+        db_password = os.getenv("DB_PASSWORD", "password")
+        db_host = os.getenv("DB_HOST", "postgres")
+        db_name = os.getenv("DB_NAME", "email_db")
+
+        self.engine = create_async_engine(
+            f"postgresql+asyncpg://{db_user}:{db_password}@{db_host}/{db_name}",
+            echo=False,
+            pool_size=int(os.getenv("DB_POOL_SIZE", 5)),
+            max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 10)),
+            pool_timeout=int(os.getenv("DB_POOL_TIMEOUT", 30)),
+            pool_pre_ping=True,
+            connect_args={"server_settings": {"timezone": "Europe/Rome"}}
+        )
+        self.Session = async_sessionmaker(self.engine, expire_on_commit=False)
+
+    async def close(self):
+        await self.engine.dispose()
+
+    async def read_email_log_page(self, limit=50, after=None):
+        """Reads a page of logs, newest first, as dicts of `LOG_LIST_COLUMNS`.
+        `after` is the (received_at, id) of the last log of the previous page."""
+        try:
+            async with self.Session() as session:
+                query = sql_select(*LOG_LIST_COLUMNS)
+                if after is not None:
+                    query = query.where(tuple_(EmailLog.received_at, EmailLog.id) < tuple_(*after))
+                query = query.order_by(EmailLog.received_at.desc(), EmailLog.id.desc()).limit(limit)
+                return [dict(row._mapping) for row in await session.execute(query)]
+        except Exception as e:
+            logging.error(f"Error reading email logs: {e}")
+            return []
+
+    async def search_email_logs(self, query, limit=20, offset=0):
+        """Ranks the logs matching a web-style query ("quoted phrases", or, -word), best first.
+        Returns a page of dicts of `LOG_LIST_COLUMNS` with the `rank` and a `headline` where the
+        matches are wrapped in <mark>, and whether more results follow."""
+        config = literal_column(f"'{SEARCH_CONFIG}'::regconfig")
+        tsquery = func.websearch_to_tsquery(config, query)
+        # Rank with the index first, the snippets are only built for the rows of the page.
+        matches = (
+            sql_select(EmailLog.id, func.ts_rank_cd(EmailLog.search, tsquery).label("rank"))
+            .where(EmailLog.search.op("@@")(tsquery))
+            .order_by(text("rank DESC"), EmailLog.received_at.desc(), EmailLog.id.desc())
+            .limit(limit + 1)
+            .offset(offset)
+            .subquery()
+        )
+        headline = func.ts_headline(
+            config, func.concat_ws(" … ", EmailLog.body, func.email_summary_text(EmailLog.summary)), tsquery,
+            "StartSel=<mark>, StopSel=</mark>, MaxFragments=2, MaxWords=25, MinWords=8"
+        )
+        try:
+            async with self.Session() as session:
+                rows = await session.execute(
+                    sql_select(*LOG_LIST_COLUMNS, matches.c.rank, headline.label("headline"))
+                    .join(matches, matches.c.id == EmailLog.id)
+                    .order_by(matches.c.rank.desc(), EmailLog.received_at.desc(), EmailLog.id.desc())
+                )
+                items = [dict(row._mapping) for row in rows]
+                return items[:limit], len(items) > limit
+        except Exception as e:
+            logging.error(f"Error searching email logs: {e}")
+            return [], False
+
+    async def read_email_log(self, email_id):
+        try:
+            async with self.Session() as session:
+                return await session.get(EmailLog, email_id)
+        except Exception as e:
+            logging.error(f"Error reading email log: {e}")
+            return None
+
+    async def read_timeline(self, email_id):
+        """Reads the timeline of an email in chronological order, as dicts."""
+        try:
+            async with self.Session() as session:
+                entries = await session.scalars(
+                    sql_select(EmailTimeline)
+                    .where(EmailTimeline.email_id == email_id)
+                    .order_by(EmailTimeline.started_at, EmailTimeline.id)
+                )
+                return [entry.to_dict() for entry in entries]
+        except Exception as e:
+            logging.error(f"Error reading the timeline of email {email_id}: {e}")
+            return []
+
+    async def requeue_email_log(self, email_id, force=False):
+        """Queues an email for processing again, unless a worker currently holds its lease.
+        Returns True if it was queued."""
+        try:
+            async with self.Session() as session:
+                result = await session.execute(
+                    update(EmailLog)
+                    .where(
+                        EmailLog.id == email_id,
+                        or_(EmailLog.status != STATUS_RUNNING, EmailLog.lease_until < func.now())
+                    )
+                    .values(
+                        status=STATUS_QUEUED,
+                        attempts=0,
+                        next_attempt_at=None,
+                        lease_until=None,
+                        **({"force": True} if force else {})
+                    )
+                )
+                if result.rowcount:
+                    await session.execute(notify_event("status", id=email_id, status=STATUS_QUEUED))
+                await session.execute(text(f"NOTIFY {QUEUE_CHANNEL}"))
+                await session.commit()
+                return result.rowcount > 0
+        except Exception as e:
+            logging.error(f"Error requeueing email log (ID: {email_id}): {e}")
+            return False
+
+    async def enqueue_outbox(self, email_id, recipients):
+        """Queues an email for the recipients that have not received it yet. Returns the outbox rows."""
+        if not recipients:
+            return []
+        try:
+            async with self.Session() as session:
+                for statement in enqueue_outbox_statements(email_id, recipients):
+                    await session.execute(statement)
+                await session.commit()
+                return list(await session.scalars(outbox_of(email_id)))
+        except Exception as e:
+            logging.error(f"Error queueing email {email_id} for delivery: {e}")
+            return []
+
+    async def read_outbox(self, status=None, email_id=None, limit=100):
+        try:
+            async with self.Session() as session:
+                query = sql_select(Outbox).order_by(Outbox.id.desc()).limit(limit)
+                if status:
+                    query = query.where(Outbox.status == status)
+                if email_id:
+                    query = query.where(Outbox.email_id == email_id)
+                return list(await session.scalars(query))
+        except Exception as e:
+            logging.error(f"Error reading outbox: {e}")
+            return []
+
+    async def retry_outbox(self, outbox_id):
+        """Requeues a failed delivery right away. Returns the row, or None if it is not failed."""
+        try:
+            async with self.Session() as session:
+                delivery = await session.get(Outbox, outbox_id, with_for_update=True)
+                if delivery is None or delivery.status != STATUS_FAILED:
+                    return None
+                delivery.status = STATUS_QUEUED
+                delivery.attempts = 0
+                delivery.next_attempt_at = None
+                await session.execute(text(f"NOTIFY {OUTBOX_CHANNEL}"))
+                await session.commit()
+                return delivery
+        except Exception as e:
+            logging.error(f"Error retrying outbox (ID: {outbox_id}): {e}")
+            return None
+
+    async def count_backlog(self):
+        """Counts emails and deliveries queued or in progress. Those that failed for good are not waiting."""
+        try:
+            async with self.Session() as session:
+                emails = await session.scalar(
+                    sql_select(func.count()).select_from(EmailLog)
+                    .where(EmailLog.status.in_([STATUS_QUEUED, STATUS_RUNNING]))
+                )
+                deliveries = await session.scalar(
+                    sql_select(func.count()).select_from(Outbox)
+                    .where(Outbox.status.in_([STATUS_QUEUED, STATUS_RUNNING]))
+                )
+                return {"emails": emails, "outbox": deliveries}
+        except Exception as e:
+            logging.error(f"Error counting the backlog: {e}")
+            return None
+
+    async def read_process_job(self, email_id):
+        """Reports the processing status of an email, or None if it does not exist."""
+        log = await self.read_email_log(email_id)
+        if log is None:
+            return None
+        return {
+            "status": log.status,
+            "attempts": log.attempts,
+            "next_attempt_at": log.next_attempt_at,
+            "error": log.last_error if log.status != STATUS_DONE else None,
+        }
+
+    async def read_forward_job(self, email_id):
+        """Reports the delivery status of an email across its recipients, or None if it was never queued."""
+        deliveries = await self.read_outbox(email_id=email_id, limit=None)
+        if not deliveries:
+            return None
+        statuses = {delivery.status for delivery in deliveries}
+        if statuses & {STATUS_QUEUED, STATUS_RUNNING}:
+            status = STATUS_RUNNING if STATUS_RUNNING in statuses else STATUS_QUEUED
+        elif STATUS_FAILED in statuses:
+            status = STATUS_FAILED
+        else:
+            status = STATUS_DONE
+        return {"status": status, "deliveries": [delivery.to_dict() for delivery in deliveries]}
@@ -0,0 +1,105 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from async_database import AsyncDatabaseManager
+from database import DatabaseManager
+from events import EventBroadcaster
+from monitor import EmailMonitor
+from parser import Parser
+from storage import AttachmentStore
+from workers.cache import LLMCache
+from workers.dispatcher import Dispatcher
+from workers.operator import Operator
+from workers.sender import Sender
+
+
+class Container:
+    """Builds each component of the app once, on first use, so they all share one database engine.
+
+    Nothing here connects at construction: `start()` connects the database and the mailbox in
+    the background and then starts the workers, so the API answers right away.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.components = {}
+        self.executor = None
+        self.started_at = None
+        self.error = None
+
+    def get(self, name, factory):
+        with self.lock:
+            if name not in self.components:
+                self.components[name] = factory()
+            return self.components[name]
+
+    @property
+    def db_manager(self) -> DatabaseManager:
+        return self.get("db_manager", lambda: DatabaseManager(connect=False))
+
+    @property
+    def async_db(self) -> AsyncDatabaseManager:
+        return self.get("async_db", AsyncDatabaseManager)
+
+    @property
+    def events(self) -> EventBroadcaster:
+        return self.get("events", lambda: EventBroadcaster(self.async_db))
+
+    @property
+    def store(self) -> AttachmentStore:
+        return self.get("store", AttachmentStore)
+
+    @property
+    def sender(self) -> Sender:
+        return self.get("sender", Sender)
+
+    @property
+    def llm_cache(self) -> LLMCache:
+        return self.get("llm_cache", lambda: LLMCache(self.db_manager))
+
+    @property
+    def operator(self) -> Operator:
+        return self.get("operator", lambda: Operator(cache=self.llm_cache))
+
+    @property
+    def parser(self) -> Parser:
+        return self.get("parser", lambda: Parser(self.db_manager, self.operator, self.sender, self.store))
+
+    @property
+    def monitor(self) -> EmailMonitor:
+        return self.get("monitor", lambda: EmailMonitor(self.db_manager, connect=False))
+
+    @property
+    def dispatcher(self) -> Dispatcher:
+        return self.get("dispatcher", lambda: Dispatcher(self.db_manager, self.sender))
+
+    def start(self, interval_seconds=60):
+        """Connects the database in the background, then starts the monitor, parser and dispatcher."""
+        self.started_at = time.time()
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.executor.submit(self.run_workers, interval_seconds)
+
+    def run_workers(self, interval_seconds):
+        try:
+            self.db_manager.connect()
+        except Exception as e:
+            self.error = str(e)
+            logging.error(f"Workers not started: {e}")
+            return
+        self.executor.submit(self.monitor.run)
+        self.executor.submit(self.parser.work, interval_seconds)
+        self.executor.submit(self.dispatcher.run, interval_seconds)
+
+    def health(self):
+        """Readiness of each component, without touching the network."""
+        with self.lock:
+            db_manager = self.components.get("db_manager")
+            monitor = self.components.get("monitor")
+        return {
+            "database": bool(db_manager and db_manager.connected),
+            "imap": bool(monitor and monitor.mail is not None),
+            "uptime_seconds": round(time.time() - self.started_at, 1) if self.started_at else None,
+            "error": self.error,
+        }
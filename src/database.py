@@ -1,20 +1,103 @@
+import json
 import logging
 import os
+import select
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Boolean, JSON
+from sqlalchemy import (
+    create_engine, text, select as sql_select, update, func, and_, or_,
+    Column, Integer, BigInteger, Float, String, DateTime, Text, Boolean, JSON, LargeBinary, Index, ForeignKey, delete,
+    Computed, DDL, event
+)
+from sqlalchemy.dialects.postgresql import insert, TSVECTOR
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import deferred, sessionmaker
 
 Base = declarative_base()
 
+# Text search configuration of the circulars, for stemming and stop words.
+SEARCH_CONFIG = "italian"
+# Unescaped text of the summaries, a JSON list of {"file", "text"}, so a "\n" does not stick to the next word.
+# A generated column only accepts IMMUTABLE expressions, hence a function rather than a subquery.
+SUMMARY_TEXT_FUNCTION = """
+CREATE OR REPLACE FUNCTION email_summary_text(summaries json) RETURNS text LANGUAGE sql IMMUTABLE AS $$
+    SELECT coalesce(string_agg(value #>> '{}', ' '), '') FROM jsonb_path_query(summaries::jsonb, '$[*].text') value
+$$
+"""
+# Document indexed for full-text search, matches in the subject rank above the summaries and the body.
+SEARCH_DOCUMENT = (
+    f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(subject, '')), 'A') || "
+    f"setweight(to_tsvector('{SEARCH_CONFIG}', email_summary_text(summary)), 'B') || "
+    f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(body, '')), 'C')"
+)
+
+# create_all only creates missing tables, so columns and indexes added later are applied here.
+MIGRATIONS = [
+    "ALTER TABLE email_log ADD COLUMN IF NOT EXISTS message_id VARCHAR(998)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_email_log_message_id ON email_log (message_id)",
+    """
+    DO $$ BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM information_schema.columns WHERE table_name = 'email_log' AND column_name = 'status'
+        ) THEN
+            ALTER TABLE email_log ADD COLUMN status VARCHAR(16) NOT NULL DEFAULT 'queued';
+            UPDATE email_log SET status = 'done' WHERE processed;
+        END IF;
+    END $$
+    """,
+    "ALTER TABLE email_log ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE email_log ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP WITH TIME ZONE",
+    "ALTER TABLE email_log ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP WITH TIME ZONE",
+    "ALTER TABLE email_log ADD COLUMN IF NOT EXISTS last_error TEXT",
+    "CREATE INDEX IF NOT EXISTS ix_email_log_queue ON email_log (status, next_attempt_at)",
+    "ALTER TABLE email_log ADD COLUMN IF NOT EXISTS force BOOLEAN NOT NULL DEFAULT false",
+    "CREATE INDEX IF NOT EXISTS ix_email_log_received_at ON email_log (received_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_email_log_unprocessed ON email_log (received_at) WHERE processed = false",
+    SUMMARY_TEXT_FUNCTION,
+    # The first version indexed the escaped JSON text of the summaries, the column is added again below.
+    """
+    DO $$ BEGIN
+        IF EXISTS (
+            SELECT 1 FROM information_schema.columns WHERE table_name = 'email_log' AND column_name = 'search'
+            AND generation_expression NOT LIKE '%email_summary_text%'
+        ) THEN
+            ALTER TABLE email_log DROP COLUMN search;
+        END IF;
+    END $$
+    """,
+    # Rewrites the table once, to fill the column for the existing emails.
+    f"ALTER TABLE email_log ADD COLUMN IF NOT EXISTS search TSVECTOR GENERATED ALWAYS AS ({SEARCH_DOCUMENT}) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_email_log_search ON email_log USING GIN (search)",
+]
+
+# Channels notified whenever emails are queued for processing or for delivery.
+QUEUE_CHANNEL = "email_log_queued"
+OUTBOX_CHANNEL = "outbox_queued"
+# Channel carrying small JSON change events, streamed to the frontend by the API's /events.
+EVENTS_CHANNEL = "email_events"
+# Characters of an error sent in an event, NOTIFY payloads must stay under 8000 bytes.
+EVENT_ERROR_LENGTH = 200
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
 
 class EmailLog(Base):
     __tablename__ = "email_log"
+    __table_args__ = (
+        Index("ix_email_log_message_id", "message_id", unique=True),
+        Index("ix_email_log_queue", "status", "next_attempt_at"),
+        Index("ix_email_log_received_at", "received_at", "id"),
+        Index("ix_email_log_unprocessed", "received_at", postgresql_where=text("processed = false")),
+        Index("ix_email_log_search", "search", postgresql_using="gin"),
+    )
 
     id = Column(Integer, primary_key=True)
+    message_id = Column(String(998), nullable=True)
     subject = Column(String(255))
     sender = Column(String(255))
     body = Column(Text)
@@ -25,6 +108,15 @@ class EmailLog(Base):
         DateTime(timezone=True),
         default=lambda: datetime.now(ZoneInfo('Europe/Rome'))
     )
+    status = Column(String(16), nullable=False, default=STATUS_QUEUED, server_default=STATUS_QUEUED)
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+    lease_until = Column(DateTime(timezone=True), nullable=True)
+    next_attempt_at = Column(DateTime(timezone=True), nullable=True)
+    last_error = Column(Text, nullable=True)
+    # Set when processing is requested again, so the worker ignores cached LLM responses.
+    force = Column(Boolean, nullable=False, default=False, server_default="false")
+    # Maintained by Postgres, deferred so loading an email does not load its index terms.
+    search = deferred(Column(TSVECTOR, Computed(SEARCH_DOCUMENT, persisted=True)))
 
     def to_dict(self):
         return {
@@ -35,29 +127,294 @@ class EmailLog(Base):
             # "attachments": self.attachments,
             "summary": self.summary,
             "processed": self.processed,
+            "status": self.status,
             "received_at": self.received_at
         }
 
 
+# The search column of a new table is computed with the function, which must exist first.
+event.listen(EmailLog.__table__, "before_create", DDL(SUMMARY_TEXT_FUNCTION))
+
+# Columns returned by the paginated log list, everything but the body and attachments.
+LOG_LIST_COLUMNS = (
+    EmailLog.id,
+    EmailLog.subject,
+    EmailLog.sender,
+    EmailLog.summary,
+    EmailLog.processed,
+    EmailLog.status,
+    EmailLog.received_at,
+)
+
+
+class MailboxState(Base):
+    __tablename__ = "mailbox_state"
+
+    mailbox = Column(String(255), primary_key=True)
+    uidvalidity = Column(BigInteger, nullable=False)
+    last_uid = Column(BigInteger, nullable=False, default=0)
+    highestmodseq = Column(BigInteger, nullable=True)
+    updated_at = Column(
+        DateTime(timezone=True),
+        default=lambda: datetime.now(ZoneInfo('Europe/Rome')),
+        onupdate=lambda: datetime.now(ZoneInfo('Europe/Rome'))
+    )
+
+
+class Outbox(Base):
+    __tablename__ = "outbox"
+    __table_args__ = (
+        Index("ix_outbox_email_recipient", "email_id", "recipient", unique=True),
+        Index("ix_outbox_queue", "status", "next_attempt_at"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    email_id = Column(Integer, ForeignKey("email_log.id", ondelete="CASCADE"), nullable=False)
+    recipient = Column(String(255), nullable=False)
+    status = Column(String(16), nullable=False, default=STATUS_QUEUED)
+    attempts = Column(Integer, nullable=False, default=0)
+    lease_until = Column(DateTime(timezone=True), nullable=True)
+    next_attempt_at = Column(DateTime(timezone=True), nullable=True)
+    last_error = Column(Text, nullable=True)
+    sent_at = Column(DateTime(timezone=True), nullable=True)
+    created_at = Column(
+        DateTime(timezone=True),
+        default=lambda: datetime.now(ZoneInfo('Europe/Rome'))
+    )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "email_id": self.email_id,
+            "recipient": self.recipient,
+            "status": self.status,
+            "attempts": self.attempts,
+            "next_attempt_at": self.next_attempt_at,
+            "last_error": self.last_error,
+            "sent_at": self.sent_at
+        }
+
+
+class EmailTimeline(Base):
+    """One stage of an email's journey: fetch, extraction of an attachment, an LLM call, a send."""
+    __tablename__ = "email_timeline"
+    __table_args__ = (
+        Index("ix_email_timeline_email", "email_id", "started_at"),
+    )
+
+    id = Column(BigInteger, primary_key=True)
+    email_id = Column(Integer, ForeignKey("email_log.id", ondelete="CASCADE"), nullable=False)
+    stage = Column(String(16), nullable=False)
+    label = Column(String(255), nullable=True)
+    started_at = Column(DateTime(timezone=True), nullable=False)
+    ended_at = Column(DateTime(timezone=True), nullable=True)
+    size = Column(Integer, nullable=True)
+    detail = Column(JSON(none_as_null=True), nullable=True)
+
+    def to_dict(self):
+        return {
+            "stage": self.stage,
+            "label": self.label,
+            "started_at": self.started_at,
+            "ended_at": self.ended_at,
+            "seconds": (self.ended_at - self.started_at).total_seconds() if self.ended_at else None,
+            "size": self.size,
+            "detail": self.detail
+        }
+
+
+def timeline_entry(stage, started_at, ended_at=None, label=None, size=None, **detail):
+    """Builds a timeline entry for `DatabaseManager.add_timeline`. Extra keywords go in `detail`."""
+    return {
+        "stage": stage,
+        "label": label[:255] if label else None,
+        "started_at": started_at,
+        "ended_at": ended_at,
+        "size": size,
+        "detail": {key: value for key, value in detail.items() if value is not None} or None
+    }
+
+
+def now():
+    return datetime.now(ZoneInfo('Europe/Rome'))
+
+
+def notify_event(event, **fields):
+    """Statement sending a change event on EVENTS_CHANNEL, delivered when the transaction commits.
+    Errors are truncated, as an oversized payload would fail, and roll back, the whole transaction."""
+    if fields.get("error"):
+        error = str(fields["error"])
+        fields["error"] = error if len(error) <= EVENT_ERROR_LENGTH else error[:EVENT_ERROR_LENGTH - 1] + "…"
+    payload = json.dumps({"type": event, **fields}, default=str)
+    return text("SELECT pg_notify(:channel, :payload)").bindparams(channel=EVENTS_CHANNEL, payload=payload)
+
+
+def enqueue_outbox_statements(email_id, recipients):
+    """Statements queueing an email for the recipients that have not received it yet.
+    Failed deliveries are requeued, delivered ones are left alone."""
+    return [
+        insert(Outbox)
+        .values([{"email_id": email_id, "recipient": recipient, "status": STATUS_QUEUED} for recipient in recipients])
+        .on_conflict_do_nothing(index_elements=["email_id", "recipient"]),
+        update(Outbox)
+        .where(Outbox.email_id == email_id, Outbox.status == STATUS_FAILED)
+        .values(status=STATUS_QUEUED, attempts=0, next_attempt_at=None),
+        text(f"NOTIFY {OUTBOX_CHANNEL}"),
+    ]
+
+
+def outbox_of(email_id):
+    """Query of the outbox rows of an email."""
+    return sql_select(Outbox).where(Outbox.email_id == email_id).order_by(Outbox.id)
+
+
+class RenderedEmail(Base):
+    __tablename__ = "rendered_email"
+
+    email_id = Column(Integer, ForeignKey("email_log.id", ondelete="CASCADE"), primary_key=True)
+    subject = Column(Text)
+    text = Column(Text)
+    html = Column(Text)
+    mime = Column(LargeBinary, nullable=False)
+    created_at = Column(
+        DateTime(timezone=True),
+        default=lambda: datetime.now(ZoneInfo('Europe/Rome'))
+    )
+
+
+def rendered_email_row(email_id, rendered):
+    """Row storing the output of `Sender.render` for an email."""
+    return RenderedEmail(
+        email_id=email_id,
+        subject=rendered["subject"],
+        text=rendered["text"],
+        html=rendered["html"],
+        mime=rendered["mime"],
+        created_at=datetime.now(ZoneInfo('Europe/Rome'))
+    )
+
+
+class LLMCacheEntry(Base):
+    __tablename__ = "llm_cache"
+    __table_args__ = (
+        Index("ix_llm_cache_last_used_at", "last_used_at"),
+    )
+
+    key = Column(String(64), primary_key=True)
+    model = Column(String(255), nullable=False)
+    response = Column(Text, nullable=False)
+    duration = Column(Float, nullable=True)
+    hits = Column(Integer, nullable=False, default=0)
+    created_at = Column(
+        DateTime(timezone=True),
+        default=lambda: datetime.now(ZoneInfo('Europe/Rome'))
+    )
+    last_used_at = Column(
+        DateTime(timezone=True),
+        default=lambda: datetime.now(ZoneInfo('Europe/Rome'))
+    )
+
+
+class ExtractionCacheEntry(Base):
+    __tablename__ = "extraction_cache"
+    __table_args__ = (
+        Index("ix_extraction_cache_last_used_at", "last_used_at"),
+    )
+
+    sha256 = Column(String(64), primary_key=True)
+    extractor = Column(String(64), primary_key=True)
+    language = Column(String(32), primary_key=True, default="")
+    text = Column(JSON)
+    created_at = Column(
+        DateTime(timezone=True),
+        default=lambda: datetime.now(ZoneInfo('Europe/Rome'))
+    )
+    last_used_at = Column(
+        DateTime(timezone=True),
+        default=lambda: datetime.now(ZoneInfo('Europe/Rome'))
+    )
+
+
+class Listener:
+    """Dedicated connection waiting for NOTIFY on a channel."""
+
+    def __init__(self, engine, channel):
+        self.engine = engine
+        self.channel = channel
+        self.connection = None
+
+    def connect(self):
+        proxy = self.engine.raw_connection()
+        # Keep the connection out of the pool, it stays in LISTEN mode for its whole life.
+        proxy.detach()
+        # driver_connection goes through the pool record, which detach() drops.
+        self.connection = proxy.dbapi_connection
+        self.connection.autocommit = True
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {self.channel}")
+
+    def wait(self, timeout):
+        """Blocks until a notification arrives or the timeout expires. Returns True if notified."""
+        try:
+            if self.connection is None:
+                self.connect()
+            if not self.connection.notifies:
+                select.select([self.connection], [], [], timeout)
+                self.connection.poll()
+            notified = bool(self.connection.notifies)
+            self.connection.notifies.clear()
+            return notified
+        except Exception as e:
+            logging.error(f"Error waiting for notifications on {self.channel}: {e}")
+            self.close()
+            time.sleep(timeout)
+            return False
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception as e:
+                logging.warning(f"Error closing listener connection: {e}")
+            self.connection = None
+
+
 class DatabaseManager:
-    def __init__(self):
+    def __init__(self, connect=True):
+        """With `connect=False` the schema is not checked until `connect()` is called,
+        e.g. from a background thread, so the caller does not wait for the database."""
         db_user = os.getenv("DB_USER", "user")
         db_password = os.getenv("DB_PASSWORD", "password")
         db_host = os.getenv("DB_HOST", "postgres")
         db_name = os.getenv("DB_NAME", "email_db")
+        self.lease_seconds = int(os.getenv("EMAIL_LEASE_SECONDS", 15 * 60))
+        self.max_attempts = int(os.getenv("EMAIL_MAX_ATTEMPTS", 3))
+        self.retry_backoff = int(os.getenv("EMAIL_RETRY_BACKOFF", 60))
+        self.outbox_max_attempts = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 5))
 
         self.engine = create_engine(
             f"postgresql+psycopg2://{db_user}:{db_password}@{db_host}/{db_name}",
             echo=False,
+            pool_size=int(os.getenv("DB_POOL_SIZE", 5)),
+            max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 10)),
+            pool_pre_ping=True,
             connect_args={'options': '-c timezone=Europe/Rome'}
         )
+        # Claimed rows are used after commit, so keep their loaded state.
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+        self.connected = False
+        if connect:
+            self.connect()
+
+    def connect(self):
         self._connect_with_retries()
 
     def _connect_with_retries(self, retries=5, delay=5):
         for attempt in range(retries):
             try:
                 Base.metadata.create_all(self.engine)
-                self.Session = sessionmaker(bind=self.engine)
+                self._migrate()
+                self.connected = True
                 print("Connected to the database.")
                 return
             except Exception as e:
@@ -65,74 +422,512 @@ class DatabaseManager:
                 time.sleep(delay)
         raise Exception("Failed to connect to the database after multiple attempts.")
 
-    def read_email_logs(self):
+    def _migrate(self):
+        with self.engine.begin() as connection:
+            for statement in MIGRATIONS:
+                connection.execute(text(statement))
+
+    def read_email_log(self, email_id):
         session = None
         try:
             session = self.Session()
-            return session.query(EmailLog).where(EmailLog.processed == False).all()
+            return session.query(EmailLog).get(email_id)
         except Exception as e:
-            print(f"Error reading email logs: {e}")
-            logging.error(f"Error reading email logs: {e}")
-            return []
+            print(f"Error reading email log: {e}")
+            logging.error(f"Error reading email log: {e}")
+            return None
         finally:
             session.close()
 
-    def read_all_email_logs(self):
+    def listen(self, channel=QUEUE_CHANNEL):
+        return Listener(self.engine, channel)
+
+    def _claim(self, session, model, condition, limit, order_by, notify=False):
+        now = func.now()
+        candidates = (
+            sql_select(model.id)
+            .where(condition)
+            .order_by(order_by)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        statement = (
+            update(model)
+            .where(model.id.in_(candidates.scalar_subquery()))
+            .values(
+                status=STATUS_RUNNING,
+                attempts=model.attempts + 1,
+                lease_until=now + timedelta(seconds=self.lease_seconds)
+            )
+            .returning(model)
+            .execution_options(synchronize_session=False)
+        )
+        rows = list(session.execute(statement).scalars())
+        if notify:
+            for row in rows:
+                session.execute(notify_event("status", id=row.id, status=STATUS_RUNNING))
+        session.commit()
+        return rows
+
+    @staticmethod
+    def _claimable(model):
+        """Queued rows that are due, or running rows whose worker let the lease expire."""
+        now = func.now()
+        return or_(
+            and_(model.status == STATUS_QUEUED, or_(model.next_attempt_at.is_(None), model.next_attempt_at <= now)),
+            and_(model.status == STATUS_RUNNING, model.lease_until < now)
+        )
+
+    def _schedule_retry(self, row, error, max_attempts):
+        """Requeues a failed row with exponential backoff, or marks it failed when attempts run out."""
+        row.lease_until = None
+        row.last_error = str(error)
+        if row.attempts >= max_attempts:
+            row.status = STATUS_FAILED
+            return None
+        delay = self.retry_backoff * 2 ** max(row.attempts - 1, 0)
+        row.status = STATUS_QUEUED
+        row.next_attempt_at = datetime.now(ZoneInfo('Europe/Rome')) + timedelta(seconds=delay)
+        return delay
+
+    def claim_email_logs(self, limit=1):
+        """Leases up to `limit` queued emails, or running ones whose lease expired, for this worker."""
         session = None
         try:
             session = self.Session()
-            return session.query(EmailLog).order_by(EmailLog.received_at.desc()).all()
+            return self._claim(session, EmailLog, self._claimable(EmailLog), limit, EmailLog.received_at, notify=True)
         except Exception as e:
-            print(f"Error reading email logs: {e}")
-            logging.error(f"Error reading email logs: {e}")
+            print(f"Error claiming email logs: {e}")
+            logging.error(f"Error claiming email logs: {e}")
+            if session:
+                session.rollback()
             return []
         finally:
-            session.close()
+            if session:
+                session.close()
 
-    def read_email_log(self, email_id):
+    def renew_email_lease(self, email_id, attempts):
+        """Extends the lease of an email claimed with `attempts`. Returns False if another worker has claimed
+        it since or it is no longer running, None if the database could not be reached."""
         session = None
         try:
             session = self.Session()
-            return session.query(EmailLog).get(email_id)
+            result = session.execute(
+                update(EmailLog)
+                .where(EmailLog.id == email_id, EmailLog.status == STATUS_RUNNING, EmailLog.attempts == attempts)
+                .values(lease_until=func.now() + timedelta(seconds=self.lease_seconds))
+            )
+            session.commit()
+            return result.rowcount == 1
         except Exception as e:
-            print(f"Error reading email log: {e}")
-            logging.error(f"Error reading email log: {e}")
+            print(f"Error renewing the lease of email log (ID: {email_id}): {e}")
+            logging.error(f"Error renewing the lease of email log (ID: {email_id}): {e}")
+            if session:
+                session.rollback()
             return None
         finally:
-            session.close()
+            if session:
+                session.close()
+
+    @staticmethod
+    def _holds_lease(log, attempts):
+        """Whether the worker that claimed `log` with `attempts` still holds it. The attempts are
+        incremented by every claim, so they tell the current holder apart from earlier ones."""
+        return log.status == STATUS_RUNNING and log.attempts == attempts
+
+    def fail_email_log(self, email_id, error, attempts=None):
+        """Releases a failed email, queueing a retry with exponential backoff until attempts run out.
+        With `attempts`, only while the worker that claimed it with them still holds it."""
+        session = None
+        try:
+            session = self.Session()
+            log = session.get(EmailLog, email_id, with_for_update=True)
+            if log is None:
+                return
+            if attempts is not None and not self._holds_lease(log, attempts):
+                logging.warning(f"Email {email_id} was claimed by another worker, not releasing it.")
+                return
+            delay = self._schedule_retry(log, error, self.max_attempts)
+            if delay is None:
+                logging.error(f"Email {email_id} failed after {log.attempts} attempts.")
+            else:
+                logging.info(f"Email {email_id} will be retried in {delay} seconds.")
+            session.execute(notify_event("status", id=email_id, status=log.status, error=log.last_error))
+            session.commit()
+        except Exception as e:
+            print(f"Error releasing email log (ID: {email_id}): {e}")
+            logging.error(f"Error releasing email log (ID: {email_id}): {e}")
+            if session:
+                session.rollback()
+        finally:
+            if session:
+                session.close()
+
+    def add_timeline(self, email_id, entries):
+        if not entries:
+            return
+        session = None
+        try:
+            session = self.Session()
+            session.execute(insert(EmailTimeline).values([{"email_id": email_id, **entry} for entry in entries]))
+            session.commit()
+        except Exception as e:
+            print(f"Error saving the timeline of email {email_id}: {e}")
+            logging.error(f"Error saving the timeline of email {email_id}: {e}")
+            if session:
+                session.rollback()
+        finally:
+            if session:
+                session.close()
+
+    def save_rendered_email(self, email_id, rendered):
+        session = None
+        try:
+            session = self.Session()
+            session.merge(rendered_email_row(email_id, rendered))
+            session.commit()
+        except Exception as e:
+            print(f"Error saving rendered email (ID: {email_id}): {e}")
+            logging.error(f"Error saving rendered email (ID: {email_id}): {e}")
+            if session:
+                session.rollback()
+        finally:
+            if session:
+                session.close()
+
+    def read_rendered_email(self, email_id):
+        session = None
+        try:
+            session = self.Session()
+            return session.get(RenderedEmail, email_id)
+        except Exception as e:
+            print(f"Error reading rendered email (ID: {email_id}): {e}")
+            logging.error(f"Error reading rendered email (ID: {email_id}): {e}")
+            return None
+        finally:
+            if session:
+                session.close()
 
-    def log_email(self, subject, sender, body, attachments=None):
-        if attachments is None:
-            attachments = []
+    def claim_outbox(self, limit=20):
+        """Leases up to `limit` deliveries that are due, oldest first."""
         session = None
         try:
             session = self.Session()
-            email_entry = EmailLog(
-                subject=subject,
-                sender=sender,
-                body=body,
-                attachments=attachments,
-                processed=False
+            return self._claim(session, Outbox, self._claimable(Outbox), limit, Outbox.id)
+        except Exception as e:
+            print(f"Error claiming outbox: {e}")
+            logging.error(f"Error claiming outbox: {e}")
+            if session:
+                session.rollback()
+            return []
+        finally:
+            if session:
+                session.close()
+
+    def complete_outbox(self, outbox_ids):
+        session = None
+        try:
+            session = self.Session()
+            delivered = session.execute(
+                update(Outbox)
+                .where(Outbox.id.in_(outbox_ids))
+                .values(status=STATUS_DONE, lease_until=None, last_error=None, sent_at=func.now())
+                .returning(Outbox.email_id, Outbox.recipient)
+            ).all()
+            for delivery in delivered:
+                session.execute(notify_event(
+                    "delivery", id=delivery.email_id, recipient=delivery.recipient, status=STATUS_DONE
+                ))
+            session.commit()
+        except Exception as e:
+            print(f"Error completing outbox: {e}")
+            logging.error(f"Error completing outbox: {e}")
+            if session:
+                session.rollback()
+        finally:
+            if session:
+                session.close()
+
+    def fail_outbox(self, outbox_id, error):
+        session = None
+        try:
+            session = self.Session()
+            delivery = session.get(Outbox, outbox_id, with_for_update=True)
+            if delivery is None:
+                return
+            delay = self._schedule_retry(delivery, error, self.outbox_max_attempts)
+            if delay is None:
+                logging.error(f"Delivery to {delivery.recipient} failed after {delivery.attempts} attempts.")
+            else:
+                logging.info(f"Delivery to {delivery.recipient} will be retried in {delay} seconds.")
+            session.execute(notify_event(
+                "delivery", id=delivery.email_id, recipient=delivery.recipient, status=delivery.status,
+                error=delivery.last_error
+            ))
+            session.commit()
+        except Exception as e:
+            print(f"Error releasing outbox (ID: {outbox_id}): {e}")
+            logging.error(f"Error releasing outbox (ID: {outbox_id}): {e}")
+            if session:
+                session.rollback()
+        finally:
+            if session:
+                session.close()
+
+    def log_emails(self, emails):
+        """Inserts a batch of emails in one transaction, skipping Message-IDs already logged.
+        Each email may carry `timeline` entries, saved with it. Returns the ids of the new rows,
+        or None if the insert failed."""
+        if not emails:
+            return []
+        session = None
+        try:
+            session = self.Session()
+            rows = [{
+                "message_id": entry.get("message_id"),
+                "subject": (entry["subject"] or "")[:255],
+                "sender": (entry["sender"] or "")[:255],
+                "body": entry["body"],
+                "attachments": entry.get("attachments") or [],
+                "processed": False
+            } for entry in emails]
+            statement = (
+                insert(EmailLog)
+                .values(rows)
+                .on_conflict_do_nothing(index_elements=["message_id"])
+                .returning(EmailLog.id, EmailLog.message_id)
             )
-            session.add(email_entry)
+            inserted = session.execute(statement).all()
+            ids = [row.id for row in inserted]
+            # RETURNING does not promise the order of VALUES, so the rows are matched by Message-ID. Emails
+            # without one are matched by id, which the sequence assigns to a single INSERT in VALUES order.
+            by_message_id = {}
+            for entry in emails:
+                if entry.get("message_id") is not None:
+                    by_message_id.setdefault(entry["message_id"], entry)
+            without_message_id = [entry for entry in emails if entry.get("message_id") is None]
+            new_emails = [(row.id, by_message_id[row.message_id]) for row in inserted if row.message_id is not None]
+            new_emails += zip(
+                sorted(row.id for row in inserted if row.message_id is None), without_message_id
+            )
+            timeline = [
+                {"email_id": email_id, **entry}
+                for email_id, email in new_emails for entry in email.get("timeline") or []
+            ]
+            if timeline:
+                session.execute(insert(EmailTimeline).values(timeline))
+            for email_id in ids:
+                session.execute(notify_event("logged", id=email_id))
+            if ids:
+                session.execute(text(f"NOTIFY {QUEUE_CHANNEL}"))
             session.commit()
+            if len(ids) < len(rows):
+                logging.info(f"Skipped {len(rows) - len(ids)} emails already logged.")
+            return ids
         except Exception as e:
-            print(f"Error logging email: {e}")
-            logging.error(f"Error logging email: {e}")
+            print(f"Error logging emails: {e}")
+            logging.error(f"Error logging emails: {e}")
+            if session:
+                session.rollback()
+            return None
         finally:
-            session.close()
+            if session:
+                session.close()
 
-    def update_email_log(self, email_log: EmailLog):
+    def update_email_log(self, email_log: EmailLog, attempts=None, rendered=None, recipients=None):
+        """Saves an email log, returning whether it did. With `attempts`, only while the worker that
+        claimed it with them still holds it, so a worker whose lease was taken over cannot overwrite it.
+        The `rendered` email is stored and queued for the `recipients` in the same transaction, so a
+        processed email always has its outbox rows."""
         session = None
         try:
             session = self.Session()
+            if attempts is not None:
+                log = session.get(EmailLog, email_log.id, with_for_update=True)
+                if log is None or not self._holds_lease(log, attempts):
+                    logging.warning(f"Email {email_log.id} was claimed by another worker, not updating it.")
+                    return False
             session.merge(email_log)
+            if rendered is not None:
+                session.merge(rendered_email_row(email_log.id, rendered))
+            if recipients:
+                for statement in enqueue_outbox_statements(email_log.id, recipients):
+                    session.execute(statement)
+            session.execute(notify_event("status", id=email_log.id, status=email_log.status))
             session.commit()
             print(f"EmailLog (ID: {email_log.id}) updated successfully.")
+            return True
         except Exception as e:
             print(f"Error updating email log (ID: {email_log.id}): {e}")
             logging.error(f"Error updating email log (ID: {email_log.id}): {e}")
             session.rollback()
+            return False
+        finally:
+            if session:
+                session.close()
+
+    def read_mailbox_state(self, mailbox):
+        session = None
+        try:
+            session = self.Session()
+            return session.get(MailboxState, mailbox)
+        except Exception as e:
+            print(f"Error reading mailbox state: {e}")
+            logging.error(f"Error reading mailbox state: {e}")
+            return None
+        finally:
+            if session:
+                session.close()
+
+    def update_mailbox_state(self, mailbox, uidvalidity, last_uid, highestmodseq=None):
+        session = None
+        try:
+            session = self.Session()
+            session.merge(MailboxState(
+                mailbox=mailbox,
+                uidvalidity=uidvalidity,
+                last_uid=last_uid,
+                highestmodseq=highestmodseq
+            ))
+            session.commit()
+        except Exception as e:
+            print(f"Error updating mailbox state ({mailbox}): {e}")
+            logging.error(f"Error updating mailbox state ({mailbox}): {e}")
+            session.rollback()
+        finally:
+            if session:
+                session.close()
+
+    def read_llm_cache(self, key, ttl_seconds):
+        """Returns a cached LLM response younger than `ttl_seconds`, recording the hit."""
+        session = None
+        try:
+            session = self.Session()
+            now = datetime.now(ZoneInfo('Europe/Rome'))
+            entry = session.get(LLMCacheEntry, key)
+            if entry is None or entry.created_at < now - timedelta(seconds=ttl_seconds):
+                return None
+            entry.hits += 1
+            entry.last_used_at = now
+            session.commit()
+            return entry
+        except Exception as e:
+            print(f"Error reading LLM cache: {e}")
+            logging.error(f"Error reading LLM cache: {e}")
+            if session:
+                session.rollback()
+            return None
+        finally:
+            if session:
+                session.close()
+
+    def write_llm_cache(self, key, model, response, duration=None):
+        session = None
+        try:
+            session = self.Session()
+            session.merge(LLMCacheEntry(
+                key=key,
+                model=model,
+                response=response,
+                duration=duration,
+                hits=0,
+                created_at=datetime.now(ZoneInfo('Europe/Rome')),
+                last_used_at=datetime.now(ZoneInfo('Europe/Rome'))
+            ))
+            session.commit()
+        except Exception as e:
+            print(f"Error writing LLM cache: {e}")
+            logging.error(f"Error writing LLM cache: {e}")
+            if session:
+                session.rollback()
+        finally:
+            if session:
+                session.close()
+
+    def prune_llm_cache(self, ttl_seconds, max_entries):
+        """Deletes expired entries and the least recently used ones beyond `max_entries`."""
+        session = None
+        try:
+            session = self.Session()
+            expired = datetime.now(ZoneInfo('Europe/Rome')) - timedelta(seconds=ttl_seconds)
+            session.execute(delete(LLMCacheEntry).where(LLMCacheEntry.created_at < expired))
+            keep = sql_select(LLMCacheEntry.key).order_by(LLMCacheEntry.last_used_at.desc()).limit(max_entries)
+            session.execute(delete(LLMCacheEntry).where(LLMCacheEntry.key.not_in(keep.scalar_subquery())))
+            session.commit()
+        except Exception as e:
+            print(f"Error pruning LLM cache: {e}")
+            logging.error(f"Error pruning LLM cache: {e}")
+            if session:
+                session.rollback()
+        finally:
+            if session:
+                session.close()
+
+    def read_extraction_cache(self, sha256, extractor, language, ttl_seconds):
+        """Returns the cached extraction entry of a file younger than `ttl_seconds`."""
+        session = None
+        try:
+            session = self.Session()
+            now = datetime.now(ZoneInfo('Europe/Rome'))
+            entry = session.get(ExtractionCacheEntry, (sha256, extractor, language))
+            if entry is None or entry.created_at < now - timedelta(seconds=ttl_seconds):
+                return None
+            entry.last_used_at = now
+            session.commit()
+            return entry
+        except Exception as e:
+            print(f"Error reading extraction cache: {e}")
+            logging.error(f"Error reading extraction cache: {e}")
+            if session:
+                session.rollback()
+            return None
+        finally:
+            if session:
+                session.close()
+
+    def write_extraction_cache(self, sha256, extractor, language, extracted):
+        session = None
+        try:
+            session = self.Session()
+            session.merge(ExtractionCacheEntry(
+                sha256=sha256,
+                extractor=extractor,
+                language=language,
+                text=extracted,
+                created_at=datetime.now(ZoneInfo('Europe/Rome')),
+                last_used_at=datetime.now(ZoneInfo('Europe/Rome'))
+            ))
+            session.commit()
+        except Exception as e:
+            print(f"Error writing extraction cache: {e}")
+            logging.error(f"Error writing extraction cache: {e}")
+            if session:
+                session.rollback()
+        finally:
+            if session:
+                session.close()
+
+    def prune_extraction_cache(self, ttl_seconds, max_entries):
+        """Deletes expired entries and the least recently used ones beyond `max_entries`."""
+        session = None
+        try:
+            session = self.Session()
+            expired = datetime.now(ZoneInfo('Europe/Rome')) - timedelta(seconds=ttl_seconds)
+            session.execute(delete(ExtractionCacheEntry).where(ExtractionCacheEntry.created_at < expired))
+            stale = (
+                sql_select(ExtractionCacheEntry.last_used_at)
+                .order_by(ExtractionCacheEntry.last_used_at.desc())
+                .offset(max_entries)
+                .limit(1)
+                .scalar_subquery()
+            )
+            session.execute(delete(ExtractionCacheEntry).where(ExtractionCacheEntry.last_used_at <= stale))
+            session.commit()
+        except Exception as e:
+            print(f"Error pruning extraction cache: {e}")
+            logging.error(f"Error pruning extraction cache: {e}")
+            if session:
+                session.rollback()
         finally:
             if session:
                 session.close()
@@ -0,0 +1,87 @@
+import asyncio
+import contextlib
+import json
+import logging
+import os
+
+import asyncpg
+
+from async_database import AsyncDatabaseManager
+from database import EVENTS_CHANNEL
+
+
+class EventBroadcaster:
+    """Fans the change events NOTIFYed on EVENTS_CHANNEL out to every `/events` subscriber.
+
+    Each API process holds a single LISTEN connection, however many dashboards are open, and
+    every subscriber gets a bounded queue. A subscriber that falls behind, or that may have
+    missed events while the connection was down, gets a `resync` event instead.
+    """
+
+    def __init__(self, db: AsyncDatabaseManager, channel=EVENTS_CHANNEL):
+        self.url = db.engine.url
+        self.channel = channel
+        self.queue_size = int(os.getenv("EVENTS_QUEUE_SIZE", 100))
+        self.subscribers = set()
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.task
+            self.task = None
+
+    async def run(self, retry_seconds=5):
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(
+                    user=self.url.username, password=self.url.password, host=self.url.host,
+                    port=self.url.port, database=self.url.database
+                )
+                closed = asyncio.Event()
+                connection.add_termination_listener(lambda _: closed.set())
+                await connection.add_listener(self.channel, self.on_notify)
+                logging.info(f"Listening for events on {self.channel}.")
+                self.broadcast({"type": "resync"})
+                await closed.wait()
+                logging.warning(f"Lost the connection listening on {self.channel}.")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Error listening for events on {self.channel}: {e}")
+            finally:
+                if connection is not None and not connection.is_closed():
+                    await connection.close()
+            await asyncio.sleep(retry_seconds)
+
+    def on_notify(self, connection, pid, channel, payload):
+        try:
+            self.broadcast(json.loads(payload))
+        except ValueError:
+            logging.warning(f"Ignoring malformed event: {payload}")
+
+    def broadcast(self, event):
+        for queue in self.subscribers:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Too far behind to catch up event by event, the client reloads instead.
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({"type": "resync"})
+
+    @contextlib.contextmanager
+    def subscribe(self):
+        """Yields a queue receiving every event until the context exits."""
+        queue = asyncio.Queue(self.queue_size)
+        self.subscribers.add(queue)
+        try:
+            yield queue
+        finally:
+            self.subscribers.discard(queue)
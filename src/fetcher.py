@@ -0,0 +1,141 @@
+import base64
+import email
+import logging
+import os
+import quopri
+import time
+from email.header import decode_header, make_header
+from email.utils import decode_rfc2231
+from urllib.parse import unquote
+
+from imapclient.response_parser import parse_fetch_response
+
+
+class BatchFetcher:
+    """Fetches emails in batches of UIDs, downloading only the parts the pipeline uses."""
+
+    def __init__(self):
+        self.batch_size = int(os.getenv("IMAP_FETCH_BATCH_SIZE", 20))
+
+    def batches(self, uids):
+        for i in range(0, len(uids), self.batch_size):
+            yield uids[i:i + self.batch_size]
+
+    @staticmethod
+    def uid_fetch(mail, uids, items):
+        uid_set = b",".join(uid if isinstance(uid, bytes) else str(uid).encode() for uid in uids).decode()
+        status, data = mail.uid("FETCH", uid_set, items)
+        if status != "OK":
+            raise RuntimeError(f"UID FETCH {items} failed: {data}")
+        return parse_fetch_response([part for part in data if part is not None], uid_is_key=True)
+
+    def fetch(self, mail, uids):
+        """Fetches a batch of emails as dicts with the headers, the text/plain body and the attachments."""
+        start = time.perf_counter()
+        structures = self.uid_fetch(mail, uids, "(BODYSTRUCTURE BODY.PEEK[HEADER])")
+        structure_time = time.perf_counter() - start
+
+        emails = {}
+        sections = {}
+        for uid, data in structures.items():
+            parts = list(self.walk_parts(data[b"BODYSTRUCTURE"]))
+            text = next((part for part in parts if part["type"] == "text/plain" and not part["filename"]), None)
+            attachments = [part for part in parts if part["filename"]]
+            wanted = ([text] if text else []) + attachments
+            emails[uid] = {
+                "uid": uid,
+                "headers": email.message_from_bytes(data[b"BODY[HEADER]"]),
+                "text": text,
+                "parts": attachments,
+                "body": "",
+                "attachments": [],
+            }
+            if wanted:
+                key = tuple(part["section"] for part in wanted)
+                sections.setdefault(key, []).append(uid)
+
+        # Messages sharing the same MIME layout are fetched with a single command.
+        size = 0
+        for key, group in sections.items():
+            items = "(" + " ".join(f"BODY.PEEK[{section}]" for section in key) + ")"
+            for uid, data in self.uid_fetch(mail, group, items).items():
+                entry = emails[uid]
+                text = entry["text"]
+                if text:
+                    payload = self.decode_payload(data.get(f"BODY[{text['section']}]".encode()), text["encoding"])
+                    entry["body"] = payload.decode(text["charset"] or "utf-8", errors="replace")
+                    size += len(payload)
+                for part in entry["parts"]:
+                    # Attachments stay transfer-encoded, the attachment store decodes them while writing.
+                    payload = data.get(f"BODY[{part['section']}]".encode()) or b""
+                    entry["attachments"].append((part["filename"], payload, part["encoding"]))
+                    size += len(payload)
+
+        elapsed = time.perf_counter() - start
+        logging.info(
+            f"Fetched batch of {len(uids)} emails ({size} bytes) in {elapsed:.2f}s "
+            f"(structure {structure_time:.2f}s, parts {elapsed - structure_time:.2f}s)."
+        )
+        return [emails[uid] for uid in sorted(emails)]
+
+    @classmethod
+    def walk_parts(cls, body, section=""):
+        """Yields the leaf parts of a parsed BODYSTRUCTURE with their IMAP section numbers."""
+        if body.is_multipart:
+            for i, child in enumerate(body[0], start=1):
+                yield from cls.walk_parts(child, f"{section}.{i}" if section else str(i))
+            return
+
+        content_type = f"{cls.to_str(body[0])}/{cls.to_str(body[1])}".lower()
+        params = cls.to_dict(body[2])
+        if content_type.startswith("text/"):
+            disposition_index = 9
+        elif content_type == "message/rfc822":
+            disposition_index = 11
+        else:
+            disposition_index = 8
+        disposition = body[disposition_index] if len(body) > disposition_index else None
+        disposition_params = cls.to_dict(disposition[1]) if isinstance(disposition, tuple) and len(disposition) > 1 else {}
+
+        yield {
+            "section": section or "1",
+            "type": content_type,
+            "charset": params.get("charset"),
+            "encoding": cls.to_str(body[5]).lower(),
+            "filename": cls.get_filename(disposition_params) or cls.get_filename(params, "name"),
+        }
+
+    @staticmethod
+    def get_filename(params, key="filename"):
+        if f"{key}*" in params:
+            value = decode_rfc2231(params[f"{key}*"])
+            if len(value) < 3:
+                return unquote(value[0])
+            charset, _, filename = value
+            return unquote(filename, encoding=charset or "utf-8", errors="replace")
+        filename = params.get(key)
+        if filename:
+            return str(make_header(decode_header(filename)))
+        return None
+
+    @staticmethod
+    def decode_payload(payload, encoding):
+        if not payload:
+            return b""
+        if encoding == "base64":
+            return base64.b64decode(payload)
+        if encoding == "quoted-printable":
+            return quopri.decodestring(payload)
+        return payload
+
+    @staticmethod
+    def to_str(value):
+        if isinstance(value, bytes):
+            return value.decode(errors="replace")
+        return value or ""
+
+    @classmethod
+    def to_dict(cls, params):
+        if not isinstance(params, tuple):
+            return {}
+        return {cls.to_str(params[i]).lower(): cls.to_str(params[i + 1]) for i in range(0, len(params) - 1, 2)}
@@ -0,0 +1,66 @@
+import os
+import threading
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# Extraction and LLM calls take seconds to minutes, the default buckets stop at 10s.
+SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+SIZE_BUCKETS = (100, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000)
+
+IMAP_FETCH_SECONDS = Histogram(
+    "infoscuola_imap_fetch_seconds", "Time to fetch one batch of emails over IMAP"
+)
+IMAP_FETCHED_EMAILS = Counter(
+    "infoscuola_imap_fetched_emails_total", "Emails fetched over IMAP"
+)
+EXTRACT_SECONDS = Histogram(
+    "infoscuola_extract_seconds", "Time to extract text, per file or per PDF page for OCR",
+    ["extractor"], buckets=SLOW_BUCKETS
+)
+LLM_REQUEST_SECONDS = Histogram(
+    "infoscuola_llm_request_seconds", "Latency of LLM requests that were not served from the cache",
+    buckets=SLOW_BUCKETS
+)
+LLM_PROMPT_CHARS = Histogram(
+    "infoscuola_llm_prompt_chars", "Size of the prompts sent to the LLM", buckets=SIZE_BUCKETS
+)
+LLM_RESPONSE_CHARS = Histogram(
+    "infoscuola_llm_response_chars", "Size of the LLM responses", buckets=SIZE_BUCKETS
+)
+SMTP_SEND_SECONDS = Histogram(
+    "infoscuola_smtp_send_seconds", "Time to send one message over SMTP"
+)
+FAILURES = Counter(
+    "infoscuola_failures_total", "Failures by pipeline stage", ["stage"]
+)
+BACKLOG = Gauge(
+    "infoscuola_backlog", "Emails and deliveries queued or in progress", ["queue"]
+)
+ATTACHMENTS_BYTES = Gauge(
+    "infoscuola_attachments_bytes", "Size of the attachment directory"
+)
+
+
+class DirectorySize:
+    """Size of a directory tree, recomputed at most every `interval` seconds since walking it is slow."""
+
+    def __init__(self, root, interval=300):
+        self.root = root
+        self.interval = interval
+        self.measured_at = 0
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        with self.lock:
+            if time.time() - self.measured_at < self.interval:
+                return
+            total = 0
+            for directory, _, files in os.walk(self.root):
+                for name in files:
+                    try:
+                        total += os.path.getsize(os.path.join(directory, name))
+                    except OSError:
+                        pass
+            ATTACHMENTS_BYTES.set(total)
+            self.measured_at = time.time()
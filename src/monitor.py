@@ -1,29 +1,46 @@
-import email
+import asyncio
 import imaplib
 import logging
 import os
 import re
 import time
 from email.header import decode_header
+from email.utils import parsedate_to_datetime
 
-from database import DatabaseManager
+from aioimaplib import aioimaplib
+
+from database import DatabaseManager, now, timeline_entry
+from fetcher import BatchFetcher
+from metrics import FAILURES, IMAP_FETCH_SECONDS, IMAP_FETCHED_EMAILS
+from storage import AttachmentStore
 
 
 class EmailMonitor:
-    def __init__(self):
+    def __init__(self, db_manager: DatabaseManager = None, connect=True):
+        """With `connect=False` the IMAP connection is opened by `run()` instead."""
         self.imap_server = os.getenv("IMAP_SERVER")
+        self.imap_ssl = os.getenv("IMAP_SSL", "true").lower() == "true"
+        self.imap_port = int(os.getenv("IMAP_PORT", 993 if self.imap_ssl else 143))
         self.email_account = os.getenv("EMAIL_ACCOUNT")
         self.password = os.getenv("PASSWORD")
-        self.mail = self.connect_to_imap()
-        self.db_manager = DatabaseManager()
-
-        os.makedirs("attachments", exist_ok=True)
+        self.idle_enabled = os.getenv("IMAP_IDLE", "true").lower() == "true"
+        # Servers may drop an IDLE after 30 minutes (RFC 2177), so re-issue it well before that.
+        self.idle_timeout = int(os.getenv("IMAP_IDLE_TIMEOUT", 25 * 60))
+        self.mailbox = "inbox"
+        self.condstore = False
+        self.mail = self.connect_to_imap() if connect else None
+        self.db_manager = db_manager or DatabaseManager()
+        self.fetcher = BatchFetcher()
+        self.store = AttachmentStore()
 
     def connect_to_imap(self):
         try:
-            mail = imaplib.IMAP4_SSL(self.imap_server, timeout=30)
+            imap = imaplib.IMAP4_SSL if self.imap_ssl else imaplib.IMAP4
+            mail = imap(self.imap_server, self.imap_port, timeout=30)
             mail.login(self.email_account, self.password)
-            mail.select("inbox")
+            status, capabilities = mail.capability()
+            self.condstore = status == "OK" and b"CONDSTORE" in capabilities[0].upper().split()
+            mail.select(self.mailbox)
             logging.info("Connected to IMAP server.")
             return mail
         except Exception as e:
@@ -41,71 +58,111 @@ class EmailMonitor:
         if not self.mail:
             logging.error("Failed to reconnect to the IMAP server.")
 
-    def fetch_email(self, email_id):
-        res, msg_data = self.mail.fetch(email_id, "(RFC822)")
-        for response_part in msg_data:
-            if isinstance(response_part, tuple):
-                return email.message_from_bytes(response_part[1])
-        return None
+    def get_mailbox_status(self):
+        """Returns UIDVALIDITY, UIDNEXT and, with CONDSTORE, HIGHESTMODSEQ of the mailbox."""
+        items = "(UIDVALIDITY UIDNEXT HIGHESTMODSEQ)" if self.condstore else "(UIDVALIDITY UIDNEXT)"
+        status, data = self.mail.status(self.mailbox, items)
+        if status != "OK":
+            raise RuntimeError(f"Failed to read mailbox status: {data}")
+        values = dict(re.findall(r"([A-Z]+) (\d+)", data[0].decode()))
+        return {
+            "uidvalidity": int(values["UIDVALIDITY"]),
+            "uidnext": int(values["UIDNEXT"]),
+            "highestmodseq": int(values["HIGHESTMODSEQ"]) if "HIGHESTMODSEQ" in values else None,
+        }
 
     def check_for_new_emails(self):
         try:
-            status, messages = self.mail.search(None, 'UNSEEN')
+            mailbox = self.get_mailbox_status()
+            state = self.db_manager.read_mailbox_state(self.mailbox)
+            if state is None or state.uidvalidity != mailbox["uidvalidity"]:
+                # Without a usable sync state, start from the unread emails like before.
+                if state is not None:
+                    logging.warning(f"UIDVALIDITY of {self.mailbox} changed. Resynchronising.")
+                last_uid = 0
+                criteria = "UNSEEN"
+            elif mailbox["uidnext"] <= state.last_uid + 1:
+                if mailbox["highestmodseq"] != state.highestmodseq:
+                    self.db_manager.update_mailbox_state(
+                        self.mailbox, state.uidvalidity, state.last_uid, mailbox["highestmodseq"]
+                    )
+                return False
+            else:
+                last_uid = state.last_uid
+                criteria = f"UID {last_uid + 1}:*"
+
+            status, messages = self.mail.uid("SEARCH", None, criteria)
             if status != "OK":
                 logging.error("Failed to search for new emails.")
                 return False
 
-            email_ids = messages[0].split()
-            if not email_ids:
+            # "UID n:*" always matches the last message, even when n is beyond it.
+            uids = [uid for uid in messages[0].split() if int(uid) > last_uid]
+            if not uids:
+                self.db_manager.update_mailbox_state(
+                    self.mailbox, mailbox["uidvalidity"], max(last_uid, mailbox["uidnext"] - 1),
+                    mailbox["highestmodseq"]
+                )
                 return False
 
-            for email_id in email_ids:
-                msg = self.fetch_email(email_id)
-                if msg:
-                    subject = self.get_email_subject(msg)
+            for batch in self.fetcher.batches(uids):
+                emails = []
+                fetch_started = now()
+                with IMAP_FETCH_SECONDS.time():
+                    fetched_emails = self.fetcher.fetch(self.mail, batch)
+                fetch_ended = now()
+                IMAP_FETCHED_EMAILS.inc(len(fetched_emails))
+                for fetched in fetched_emails:
+                    headers = fetched["headers"]
+                    subject = self.get_email_subject(headers)
                     logging.info(f"New email received: {subject}")
-                    body = self.get_email_body(msg).strip()
-                    sender = msg["From"]
-                    attachments = self.process_attachments(msg)
-                    self.db_manager.log_email(
-                        subject=subject,
-                        sender=sender,
-                        body=body,
-                        attachments=attachments
-                    )
+                    attachments = [
+                        self.store.save(payload, filename, encoding)
+                        for filename, payload, encoding in fetched["attachments"]
+                    ]
+                    body = fetched["body"].strip()
+                    timeline = []
+                    received_at = self.get_date(headers)
+                    if received_at is not None:
+                        timeline.append(timeline_entry("received", received_at, received_at))
+                    timeline.append(timeline_entry(
+                        "fetched", fetch_started, fetch_ended,
+                        size=len(body.encode()) + sum(attachment["size"] for attachment in attachments),
+                        attachments=len(attachments), batch=len(fetched_emails)
+                    ))
+                    emails.append({
+                        "message_id": self.get_message_id(headers),
+                        "subject": subject,
+                        "sender": headers["From"],
+                        "body": body,
+                        "attachments": attachments,
+                        "timeline": timeline
+                    })
+                if self.db_manager.log_emails(emails) is None:
+                    FAILURES.labels(stage="fetch").inc()
+                    logging.error("Failed to log fetched emails. Retrying on the next check.")
+                    return False
+                self.mark_seen(batch)
+                last_uid = max(last_uid, *(int(uid) for uid in batch))
+                self.db_manager.update_mailbox_state(
+                    self.mailbox, mailbox["uidvalidity"], last_uid, mailbox["highestmodseq"]
+                )
+            self.db_manager.update_mailbox_state(
+                self.mailbox, mailbox["uidvalidity"], max(last_uid, mailbox["uidnext"] - 1),
+                mailbox["highestmodseq"]
+            )
             return True
 
         except imaplib.IMAP4.abort as e:
+            FAILURES.labels(stage="fetch").inc()
             logging.warning(f"IMAP connection aborted: {e}")
             self.reconnect_to_imap()
             return False
         except Exception as e:
+            FAILURES.labels(stage="fetch").inc()
             logging.error(f"Error while checking for new emails: {e}")
             return False
 
-    @staticmethod
-    def get_email_body(msg):
-        """Extracts and decodes the email body from the message object."""
-        if msg.is_multipart():
-            for part in msg.walk():
-                if part.get_content_type() == "text/plain":
-                    charset = part.get_content_charset()
-                    body = part.get_payload(decode=True)
-                    if charset:
-                        body = body.decode(charset, errors='replace')
-                    else:
-                        body = body.decode(errors='replace')
-                    return body
-            return ""
-        else:
-            charset = msg.get_content_charset()
-            body = msg.get_payload(decode=True)
-            if charset:
-                body = body.decode(charset, errors='replace')
-            else:
-                body = body.decode(errors='replace')
-            return body
-
     @staticmethod
     def get_email_subject(msg):
         subject, encoding = decode_header(msg["Subject"])[0]
@@ -113,29 +170,96 @@ class EmailMonitor:
             subject = subject.decode(encoding if encoding else "utf-8")
         return subject
 
-    def process_attachments(self, msg):
-        attachments = []
-        for part in msg.walk():
-            if part.get_content_maintype() == "multipart":
-                continue
-            filename = part.get_filename()
-            if filename:
-                safe_filename = self.save_attachment(part, filename)
-                attachments.append({
-                    "file": safe_filename,
-                })
-        return attachments
+    @staticmethod
+    def get_date(msg):
+        """The Date header as an aware datetime, or None when it is missing or malformed."""
+        try:
+            date = parsedate_to_datetime(msg["Date"])
+        except (TypeError, ValueError):
+            return None
+        return date if date.tzinfo else None
 
     @staticmethod
-    def save_attachment(part, filename):
-        safe_filename = re.sub(r'[^a-zA-Z0-9._-]', '', filename)
-        filepath = os.path.join("attachments", safe_filename)
-        with open(filepath, "wb") as file:
-            file.write(part.get_payload(decode=True))
-        logging.info(f"Attachment saved: {filepath}")
-        return safe_filename
+    def get_message_id(msg):
+        message_id = msg["Message-ID"]
+        return message_id.strip()[:998] if message_id else None
+
+    def mark_seen(self, uids):
+        uid_set = b",".join(uids).decode()
+        self.mail.uid("STORE", uid_set, "+FLAGS", "(\\Seen)")
+
+    def check_mail(self):
+        """Checks the inbox until no new emails are left, reconnecting if the connection went stale."""
+        if self.mail is None:
+            self.reconnect_to_imap()
+            if self.mail is None:
+                return
+        try:
+            self.mail.noop()
+        except (imaplib.IMAP4.abort, OSError):
+            logging.warning("IMAP server disconnected. Reconnecting...")
+            self.reconnect_to_imap()
+            if self.mail is None:
+                return
+        while self.check_for_new_emails():
+            continue
+
+    async def connect_idle_client(self):
+        imap = aioimaplib.IMAP4_SSL if self.imap_ssl else aioimaplib.IMAP4
+        client = imap(host=self.imap_server, port=self.imap_port, timeout=30)
+        await client.wait_hello_from_server()
+        await client.login(self.email_account, self.password)
+        await client.select("INBOX")
+        return client
+
+    async def idle(self, wait=60):
+        """Waits for EXISTS notifications over IMAP IDLE. Returns if the server does not support IDLE."""
+        while True:
+            client = None
+            try:
+                client = await self.connect_idle_client()
+                if not client.has_capability("IDLE"):
+                    logging.info("IMAP server does not support IDLE. Falling back to polling.")
+                    return
+                logging.info(f"Waiting for new emails with IMAP IDLE (re-issued every {self.idle_timeout} seconds).")
+                await asyncio.to_thread(self.check_mail)
+                while True:
+                    idle = await client.idle_start(timeout=self.idle_timeout)
+                    new_mail = False
+                    while client.has_pending_idle():
+                        msg = await client.wait_server_push(timeout=self.idle_timeout + wait)
+                        if msg != aioimaplib.STOP_WAIT_SERVER_PUSH:
+                            lines = [line.decode(errors="replace") if isinstance(line, bytes) else line for line in msg]
+                            if not any(line.endswith("EXISTS") for line in lines):
+                                continue
+                            new_mail = True
+                        client.idle_done()
+                        await asyncio.wait_for(idle, wait)
+                    if new_mail:
+                        logging.info("IMAP IDLE: new email notification received.")
+                    # Also checked when IDLE is only re-issued, so emails that failed to be logged
+                    # are retried without waiting for the next one to arrive.
+                    await asyncio.to_thread(self.check_mail)
+            except Exception as e:
+                logging.error(f"IMAP IDLE error: {e}. Reconnecting in {wait} seconds.")
+                await asyncio.sleep(wait)
+            finally:
+                if client:
+                    try:
+                        await client.logout()
+                    except Exception as e:
+                        logging.warning(f"Error during IDLE logout: {e}")
 
     def run(self):
+        if self.idle_enabled:
+            try:
+                asyncio.run(self.idle())
+            except KeyboardInterrupt:
+                logging.info("Stopped email checker.")
+                return
+        self.poll()
+
+    def poll(self):
         wait = 60
         try:
             while True:
@@ -144,7 +268,7 @@ class EmailMonitor:
                         logging.warning("IMAP connection is None. Reconnecting...")
                         self.reconnect_to_imap()
                         if self.mail is None:
-                            logging.error("Unable to reconnect. Retrying in {wait} seconds.")
+                            logging.error(f"Unable to reconnect. Retrying in {wait} seconds.")
                             time.sleep(wait)
                             continue
 
@@ -1,29 +1,65 @@
+import asyncio
+import contextlib
 import logging
-import time
+import os
+import threading
 
-from database import DatabaseManager, EmailLog
+from database import DatabaseManager, EmailLog, STATUS_DONE, now, timeline_entry
+from metrics import FAILURES
+from readers.cache import ExtractionCache
 from readers.docs import DocReader
+from readers.image import ImageReader
 from readers.pdf import PDFReader
+from storage import AttachmentStore
+from workers.cache import LLMCache
 from workers.operator import Operator
 from workers.sender import Sender
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 
+IMAGE_EXTENSIONS = ("jpg", "jpeg", "png", "gif")
+
 
 class Parser:
-    def __init__(self):
-        self.db_manager = DatabaseManager()
+    def __init__(self, db_manager: DatabaseManager = None, operator: Operator = None, sender: Sender = None,
+                 store: AttachmentStore = None):
+        self.db_manager = db_manager or DatabaseManager()
+        self.store = store or AttachmentStore()
         self.pdf_reader = PDFReader()
         self.doc_reader = DocReader()
-        self.operator = Operator()
-        self.sender = Sender()
+        self.image_reader = ImageReader()
+        self.extraction_cache = ExtractionCache(self.db_manager)
+        self.operator = operator or Operator(cache=LLMCache(self.db_manager))
+        self.sender = sender or Sender()
+        self.batch_size = int(os.getenv("PARSER_BATCH_SIZE", 1))
         logging.info("Parser initialized.")
 
-    def process_email(self, log: EmailLog):
+    async def summarise(self, log: EmailLog, timeline: list, force=False):
+        """Rewrites the body while the attachments are extracted, then summarises them concurrently.
+        The extractions and LLM requests are appended to `timeline`."""
+        session = self.operator.session(use_cache=not force)
+        session.timeline = timeline
+        body = asyncio.create_task(self.operator.ask_async(
+            f"Riscrivi il seguente testo conservando solo i contenuti essenziali: {log.body}", session, "body"
+        ))
+        attachments = await asyncio.to_thread(self.process_attachments, log.attachments, timeline)
+        summaries = await self.operator.summarise_documents_async(attachments, session)
+        body = await body
+        # ask_async logs LLM errors and returns None, fail so the email is retried rather than sent empty.
+        if body is None:
+            raise RuntimeError("The LLM did not rewrite the body.")
+        missing = [summary["file"] for summary in summaries if summary["text"] is None]
+        if missing:
+            raise RuntimeError(f"The LLM did not summarise {', '.join(missing)}.")
+        return body, attachments, summaries
+
+    def process_email(self, log: EmailLog, force=False):
+        """Processes an email. With `force`, or if the email was requeued with it, cached LLM responses are ignored."""
+        started_at = now()
+        timeline = []
         try:
-            body = self.operator.ask(f"Riscrivi il seguente testo conservando solo i contenuti essenziali: {log.body}")
-            attachments = self.process_attachments(log.attachments)
-            summaries = self.operator.summarise_documents(attachments)
+            with self.hold_lease(log):
+                body, attachments, summaries = asyncio.run(self.summarise(log, timeline, force or log.force))
             result = EmailLog(
                 id=log.id,
                 subject=log.subject,
@@ -32,65 +68,168 @@ class Parser:
                 attachments=attachments,
                 summary=summaries,
                 processed=True,
-                received_at=log.received_at
+                received_at=log.received_at,
+                status=STATUS_DONE,
+                lease_until=None,
+                last_error=None,
+                force=False
             )
-            self.db_manager.update_email_log(result)
-            self.sender.send_emails(result)
+            rendered = self.sender.render(result)
+            if not self.db_manager.update_email_log(result, log.attempts, rendered, self.sender.recipients):
+                raise RuntimeError("The email could not be saved, or its lease was taken over by another worker.")
+            timeline.append(timeline_entry("processed", started_at, now(), size=len(body or "")))
             logging.info(f"Processed email: {log.id}")
             return result.to_dict()
         except Exception as e:
+            FAILURES.labels(stage="process").inc()
             logging.error(f"Failed to process email {log.id}: {e}")
+            self.db_manager.fail_email_log(log.id, e, log.attempts)
+            timeline.append(timeline_entry("processed", started_at, now(), error=str(e)))
             return None
+        finally:
+            self.db_manager.add_timeline(log.id, timeline)
+
+    @contextlib.contextmanager
+    def hold_lease(self, log: EmailLog):
+        """Renews the lease on a claimed email while the block runs, so a slow email is not claimed again."""
+        stop = threading.Event()
 
-    def process_unprocessed_emails(self):
-        logs = self.db_manager.read_email_logs()
-        logging.info(f"Read {len(logs)} emails.")
-        for log in logs:
-            self.process_email(log)
+        def renew():
+            while not stop.wait(self.db_manager.lease_seconds / 3):
+                if self.db_manager.renew_email_lease(log.id, log.attempts) is False:
+                    logging.warning(f"Lost the lease on email {log.id}.")
+                    return
+
+        thread = threading.Thread(target=renew, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
 
-    def start_periodic_check(self, interval_seconds=10):
-        """Run periodic check for unprocessed emails."""
-        logging.info(f"Starting periodic check for unprocessed emails every {interval_seconds} seconds.")
+    def process_queued_emails(self):
+        """Claims and processes queued emails until none are left. Returns the number processed."""
+        count = 0
         while True:
-            try:
-                self.process_unprocessed_emails()
-            except Exception as e:
-                logging.error(f"Error during periodic check: {e}")
-            finally:
-                logging.info(f"Sleeping for {interval_seconds} seconds.")
-                time.sleep(interval_seconds)
-
-    def process_attachments(self, attachments: list):
+            logs = self.db_manager.claim_email_logs(self.batch_size)
+            if not logs:
+                return count
+            logging.info(f"Claimed {len(logs)} emails.")
+            for log in logs:
+                self.process_email(log)
+            count += len(logs)
+
+    def work(self, interval_seconds=60):
+        """Process queued emails, waking up on NOTIFY or at least every `interval_seconds` for retries."""
+        logging.info(f"Parser worker started, checking for queued emails at least every {interval_seconds} seconds.")
+        listener = self.db_manager.listen()
+        try:
+            while True:
+                try:
+                    self.process_queued_emails()
+                except Exception as e:
+                    logging.error(f"Error while processing queued emails: {e}")
+                listener.wait(interval_seconds)
+        finally:
+            listener.close()
+
+    def process_attachments(self, attachments: list, timeline: list = None):
+        """Extracts the text of each attachment, appending one `extract` entry per file to `timeline`.
+        Images are all sent to the OCR pool first, so the photos of one email are read in parallel."""
         if not attachments:
             logging.info("No attachments to process.")
             return []
-        results = []
+        files = []
         for attachment in attachments:
-            logging.info(f"Processing attachment: {attachment['file']}")
             attachment_file = attachment["file"]
-            ext = attachment_file.split(".")[-1]
+            ext = attachment_file.split(".")[-1].lower()
             if ext == "pdf":
-                self.pdf_reader.set_file_path(f"attachments/{attachment_file}")
-                text = self.pdf_reader.extract_text()
-                if text:
-                    results.append({
-                        "file": attachment_file,
-                        "text": text
-                    })
-                else:
-                    ocr = self.pdf_reader.ocr_images()
-                    results.append({
-                        "file": attachment_file,
-                        "text": ocr
-                    })
+                extractor, language = self.pdf_reader.version, self.pdf_reader.language
             elif ext in ["doc", "docx"]:
-                self.doc_reader.set_file_path(f"attachments/{attachment_file}")
-                text = self.doc_reader.extract_text()
+                extractor, language = self.doc_reader.version, ""
+            elif ext in IMAGE_EXTENSIONS:
+                extractor, language = self.image_reader.version, self.image_reader.language
+            else:
+                continue
+            path = self.store.path(attachment)
+            sha256 = attachment.get("sha256") or self.store.hash_file(path)
+            files.append((attachment, path, ext, extractor, language, sha256))
+
+        cached = {
+            sha256: self.extraction_cache.get(sha256, extractor, language)
+            for _, _, _, extractor, language, sha256 in files
+        }
+        self.image_reader.prefetch([
+            path for _, path, ext, _, _, sha256 in files if ext in IMAGE_EXTENSIONS and cached[sha256] is None
+        ])
+        results = []
+        try:
+            for attachment, path, ext, extractor, language, sha256 in files:
+                attachment_file = attachment["file"]
+                logging.info(f"Processing attachment: {attachment_file}")
+                started_at = now()
+                detail = {}
+                text = cached[sha256]
+                if text is None:
+                    try:
+                        text = self.extract_text(path, ext, detail)
+                    except Exception as e:
+                        FAILURES.labels(stage="extract").inc()
+                        if timeline is not None:
+                            timeline.append(timeline_entry(
+                                "extract", started_at, now(), label=attachment_file, error=str(e), **detail
+                            ))
+                        raise
+                    # A failed OCR is retried next time rather than cached.
+                    if not detail.get("error"):
+                        self.extraction_cache.put(sha256, extractor, language, text)
+                else:
+                    detail["method"] = "cache"
+                    logging.info(f"Using cached extraction for {attachment_file}.")
+                if timeline is not None:
+                    timeline.append(timeline_entry(
+                        "extract", started_at, now(), label=attachment_file, size=len(text or ""),
+                        file_size=attachment.get("size"), **detail
+                    ))
                 results.append({
                     "file": attachment_file,
                     "text": text
                 })
-            elif ext in ["jpg", "jpeg", "png", "gif"]:
-                # TODO: Pass the image to a model for seeing its contents.
-                logging.info(f"Processing image attachment with extension: {ext}")
+        finally:
+            self.image_reader.discard()
         return results
+
+    def extract_text(self, path, ext, detail: dict = None):
+        """Extracts the text of a file. `detail`, if given, is filled with the method and page counts."""
+        detail = {} if detail is None else detail
+        if ext == "pdf":
+            self.pdf_reader.set_file_path(path)
+            pages = list(self.pdf_reader.extract_pages(self.pdf_reader.language))
+            ocr_pages = sum(1 for page in pages if page["method"] == "ocr")
+            logging.info(f"Extracted {len(pages)} pages ({ocr_pages} with OCR) from {path}.")
+            detail.update(
+                method="ocr" if ocr_pages == len(pages) and pages else "mixed" if ocr_pages else "text",
+                pages=len(pages), ocr_pages=ocr_pages
+            )
+            failed = [page for page in pages if page["error"]]
+            if failed:
+                # Keeps the partial text out of the cache, so the pages are OCRed again on the next attempt.
+                FAILURES.labels(stage="extract").inc()
+                detail["error"] = f"OCR failed on page {', '.join(str(page['page']) for page in failed)}: " \
+                                  f"{failed[0]['error']}"
+            return "\n".join(page["text"] for page in pages)
+        if ext in IMAGE_EXTENSIONS:
+            self.image_reader.set_file_path(path)
+            return self.image_reader.extract_text(detail)
+        detail["method"] = ext
+        self.doc_reader.set_file_path(path, ext)
+        return self.doc_reader.extract_text()
+
+
+if __name__ == "__main__":
+    if os.getenv("METRICS_PORT"):
+        # A standalone worker is not scraped through the API, so it serves its own metrics.
+        from prometheus_client import start_http_server
+        start_http_server(int(os.getenv("METRICS_PORT")))
+    Parser().work()
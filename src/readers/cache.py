@@ -0,0 +1,24 @@
+import os
+
+from database import DatabaseManager
+
+
+class ExtractionCache:
+    """Extracted attachment text keyed by file hash, extractor version and OCR language."""
+
+    def __init__(self, db_manager: DatabaseManager):
+        self.db_manager = db_manager
+        self.ttl = int(os.getenv("EXTRACTION_CACHE_TTL", 90 * 24 * 3600))
+        self.max_entries = int(os.getenv("EXTRACTION_CACHE_MAX_ENTRIES", 5000))
+        self.prune_every = 100
+        self.writes = 0
+
+    def get(self, sha256, extractor, language=""):
+        entry = self.db_manager.read_extraction_cache(sha256, extractor, language, self.ttl)
+        return entry.text if entry else None
+
+    def put(self, sha256, extractor, language, text):
+        self.db_manager.write_extraction_cache(sha256, extractor, language, text)
+        self.writes += 1
+        if self.writes % self.prune_every == 0:
+            self.db_manager.prune_extraction_cache(self.ttl, self.max_entries)
@@ -1,33 +1,149 @@
-import textract
-from docx import Document
+import importlib
+import multiprocessing
+import os
+import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from metrics import EXTRACT_SECONDS
+
+# python-docx is imported in the worker processes, where the documents are read.
+
+doc_pool = None
+doc_pool_lock = threading.Lock()
+
+
+def limit_memory(memory_limit):
+    """Caps the address space of a worker, and of the converters it starts, so a malformed
+    document fails with MemoryError instead of exhausting the machine."""
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource and memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+
+def init_worker(memory_limit):
+    """Starts a worker: limits its memory, then loads python-docx once rather than once per document."""
+    limit_memory(memory_limit)
+    importlib.import_module("docx")
+
+
+def get_doc_pool(workers, memory_limit):
+    """Returns the process pool shared by all .doc and .docx extraction in this process."""
+    global doc_pool
+    with doc_pool_lock:
+        if doc_pool is None:
+            doc_pool = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker, initargs=(memory_limit,)
+            )
+        return doc_pool
+
+
+def reset_doc_pool(kill=False):
+    """Drops the pool, killing its workers with `kill`, as a worker stuck on a document cannot be cancelled."""
+    global doc_pool
+    with doc_pool_lock:
+        if doc_pool is not None:
+            if kill:
+                for process in list(doc_pool._processes.values()):
+                    process.kill()
+            doc_pool.shutdown(wait=False, cancel_futures=True)
+            doc_pool = None
+
+
+def iter_docx_blocks(container):
+    """Yields the text of the paragraphs and table rows of a .docx body or cell, in document order.
+    The cells of a row are joined with " | ", merged cells only once."""
+    from docx.table import Table
+
+    for block in container.iter_inner_content():
+        if isinstance(block, Table):
+            for row in block.rows:
+                cells = []
+                previous = None
+                for cell in row.cells:
+                    # python-docx repeats a merged cell once for each grid column it spans, adjacent
+                    # cells with the same text are still distinct.
+                    if previous is not None and cell._tc is previous._tc:
+                        continue
+                    previous = cell
+                    text = "\n".join(iter_docx_blocks(cell)).strip()
+                    if text:
+                        cells.append(text)
+                if cells:
+                    yield " | ".join(cells)
+        else:
+            yield block.text
+
+
+def extract_docx(path):
+    from docx import Document
+
+    return "\n".join(iter_docx_blocks(Document(path)))
+
+
+def extract_doc(path, timeout):
+    """Converts a legacy Word file with antiword, with no line wrapping and UTF-8 output."""
+    result = subprocess.run(
+        ["antiword", "-w", "0", "-m", "UTF-8.txt", path], capture_output=True, timeout=timeout
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode("utf-8", errors="replace").strip() or f"exit {result.returncode}")
+    return result.stdout.decode("utf-8", errors="replace")
+
+
+def extract_file(path, file_type, timeout):
+    """Extracts a document in a worker process."""
+    try:
+        if file_type == "docx":
+            return extract_docx(path)
+        return extract_doc(path, timeout)
+    except Exception as e:
+        # Some errors cannot be unpickled in the parent and would break the whole pool.
+        raise RuntimeError(f"{type(e).__name__}: {e}") from None
+
 
 class DocReader:
+    # Bump when the extraction output changes, so cached extractions are not reused.
+    version = "doc-3"
+
     def __init__(self):
         self.file_path = None
+        self.file_type = None
+        self.workers = int(os.getenv("DOC_WORKERS", 2))
+        self.timeout = int(os.getenv("DOC_TIMEOUT", 60))
+        self.memory_limit = int(os.getenv("DOC_MEMORY_LIMIT_MB", 1024)) * 1024 * 1024
 
-    def set_file_path(self, file_path):
+    def set_file_path(self, file_path, file_type=None):
+        """Sets the file to read. `file_type` is needed when the path has no extension."""
         self.file_path = file_path
+        self.file_type = file_type or os.path.splitext(file_path)[1].lstrip('.').lower()
 
     def extract_text(self):
-        if self.file_path.endswith('.docx'):
-            return self._extract_text_docx()
-        elif self.file_path.endswith('.doc'):
-            return self._extract_text_doc()
-        else:
+        if self.file_type not in ('doc', 'docx'):
             raise ValueError("Unsupported file format. Only .doc and .docx files are supported.")
+        extractor = "docx" if self.file_type == 'docx' else "antiword"
+        with EXTRACT_SECONDS.labels(extractor=extractor).time():
+            return self._extract_in_pool()
 
-    def _extract_text_docx(self):
-        """Extracts text from a .docx file using python-docx."""
-        text = []
-        document = Document(self.file_path)
-        for paragraph in document.paragraphs:
-            text.append(paragraph.text)
-        return '\n'.join(text)
-
-    def _extract_text_doc(self):
-        """Extracts text from a .doc file using textract."""
+    def _extract_in_pool(self):
+        """Extracts the file in a pooled worker, killing the workers if it takes longer than the timeout."""
         try:
-            text = textract.process(self.file_path).decode('utf-8')
-        except Exception as e:
-            raise RuntimeError(f"Failed to extract text from .doc file: {e}")
-        return text
+            future = get_doc_pool(self.workers, self.memory_limit).submit(
+                extract_file, self.file_path, self.file_type, self.timeout
+            )
+            # The margin covers waiting behind another document.
+            return future.result(timeout=self.timeout * 2)
+        except TimeoutError:
+            reset_doc_pool(kill=True)
+            raise RuntimeError(f"Extracting text from {self.file_path} timed out.")
+        except BrokenProcessPool:
+            # A worker died, most likely killed for exceeding the memory limit.
+            reset_doc_pool()
+            raise RuntimeError(f"The worker extracting {self.file_path} died.")
+        except RuntimeError as e:
+            raise RuntimeError(f"Failed to extract text from .{self.file_type} file: {e}") from None
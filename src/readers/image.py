@@ -0,0 +1,137 @@
+import logging
+import os
+import time
+from concurrent.futures import TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from metrics import EXTRACT_SECONDS, FAILURES
+from readers.pdf import get_ocr_pool, reset_ocr_pool, wait_for_ocr
+
+# PIL and pytesseract are imported in the worker processes, where the images are read.
+
+
+def skew_angle(image, max_angle=5.0, size=600):
+    """Angle in degrees that straightens the text lines of a grayscale image.
+
+    Tries angles on a small binarised copy, in whole degrees and then in quarters around the best,
+    and keeps the one whose rows differ the most, as rows are then either all text or all blank.
+    """
+    from PIL import Image, ImageOps
+
+    small = ImageOps.autocontrast(image.copy())
+    small.thumbnail((size, size))
+    # Text becomes white on black, so the corners uncovered by rotating count as blank.
+    ink = small.point(lambda value: 255 if value < 128 else 0)
+
+    def score(angle):
+        # Shrinking to one column with a box filter averages each row.
+        rows = list(ink.rotate(angle, resample=Image.BILINEAR).resize((1, ink.height), Image.BOX).getdata())
+        mean = sum(rows) / len(rows)
+        return sum((value - mean) ** 2 for value in rows)
+
+    best = max(range(-int(max_angle), int(max_angle) + 1), key=score)
+    return max((best + quarter / 4 for quarter in range(-3, 4)), key=score)
+
+
+def prepare_image(path, max_side):
+    """Loads a photo or scan for OCR: upright, grayscale, at most `max_side` pixels a side and deskewed.
+    Returns the image and what was done to it."""
+    from PIL import Image, ImageOps
+
+    image = Image.open(path)
+    width, height = image.size
+    # JPEG decodes straight to grayscale at a fraction of the size, far cheaper than resizing later.
+    image.draft("L", (max_side, max_side))
+    image = ImageOps.exif_transpose(image).convert("L")
+    if max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+    angle = skew_angle(image)
+    # Tesseract copes with a slight skew, rotating the full image is only worth it beyond that.
+    if abs(angle) >= 0.5:
+        image = image.rotate(angle, resample=Image.BILINEAR, expand=True, fillcolor=255)
+    return image, {"width": width, "height": height, "ocr_width": image.width, "ocr_height": image.height,
+                   "angle": angle}
+
+
+def ocr_image_file(path, language, timeout, max_side):
+    """Prepares and OCRs an image file in a worker process. Returns the text, the times and the details."""
+    import pytesseract
+
+    try:
+        start = time.perf_counter()
+        image, detail = prepare_image(path, max_side)
+        prepared = time.perf_counter()
+        text = pytesseract.image_to_string(image, lang=language, timeout=timeout)
+    except Exception as e:
+        # pytesseract errors cannot be unpickled in the parent and would break the whole pool.
+        raise RuntimeError(f"{type(e).__name__}: {e}") from None
+    return text, prepared - start, time.perf_counter() - prepared, detail
+
+
+class ImageReader:
+    """OCRs photos and scans sent as image attachments, in the OCR pool shared with `PDFReader`."""
+    # Bump when the extraction output changes, so cached extractions are not reused.
+    version = "image-1"
+
+    def __init__(self):
+        self.file_path = None
+        self.language = os.getenv("OCR_LANGUAGE", "ita")
+        self.ocr_workers = int(os.getenv("OCR_WORKERS", os.cpu_count() or 1))
+        self.ocr_timeout = int(os.getenv("OCR_PAGE_TIMEOUT", 120))
+        # About A4 at 250 DPI. Phone photos are larger, and Tesseract time grows with the pixels.
+        self.max_side = int(os.getenv("OCR_IMAGE_MAX_SIDE", 3000))
+        self.pending = {}
+
+    def set_file_path(self, file_path):
+        self.file_path = file_path
+
+    def prefetch(self, paths, language=None):
+        """Starts the OCR of several images at once, so `extract_text` only collects their results."""
+        for path in paths:
+            if path not in self.pending:
+                self.pending[path] = self.submit(path, language)
+
+    def submit(self, path, language=None):
+        try:
+            return get_ocr_pool(self.ocr_workers).submit(
+                ocr_image_file, path, language or self.language, self.ocr_timeout, self.max_side
+            )
+        except BrokenProcessPool:
+            reset_ocr_pool()
+            raise
+
+    def extract_text(self, detail: dict = None):
+        """Returns the text of the image, filling `detail` with its size, skew and timings.
+        Like a PDF page, an image that fails or times out yields an empty text and the error."""
+        detail = {} if detail is None else detail
+        detail["method"] = "ocr"
+        future = self.pending.pop(self.file_path, None) or self.submit(self.file_path)
+        try:
+            # Tesseract is killed after the timeout. The pool hands one task more than it has workers,
+            # the margin covers that task waiting for a free worker.
+            text, prepare_time, ocr_time, image_detail = wait_for_ocr(future, self.ocr_timeout * 2)
+        except BrokenProcessPool:
+            reset_ocr_pool()
+            raise
+        except TimeoutError:
+            future.cancel()
+            FAILURES.labels(stage="ocr").inc()
+            detail["error"] = "timeout"
+            logging.warning(f"OCR of {self.file_path} timed out.")
+            return ""
+        except Exception as e:
+            FAILURES.labels(stage="ocr").inc()
+            detail["error"] = str(e)
+            logging.error(f"OCR of {self.file_path} failed: {e}")
+            return ""
+        EXTRACT_SECONDS.labels(extractor="image_prepare").observe(prepare_time)
+        EXTRACT_SECONDS.labels(extractor="ocr_image").observe(ocr_time)
+        detail.update(prepare_seconds=round(prepare_time, 3), ocr_seconds=round(ocr_time, 3), **image_detail)
+        logging.info(f"OCR of {self.file_path} took {prepare_time:.2f}s to prepare and {ocr_time:.2f}s to read.")
+        return text
+
+    def discard(self):
+        """Cancels the OCR of prefetched images that were not collected."""
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
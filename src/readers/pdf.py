@@ -1,63 +1,154 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
-import fitz
-import PyPDF2
-import pytesseract
-from PIL import Image
+
+from metrics import EXTRACT_SECONDS, FAILURES
+
+# fitz, pytesseract and PIL are imported where they are used, so processes that never
+# read a PDF (like the API) do not pay for loading them.
+
+ocr_pool = None
+ocr_pool_lock = threading.Lock()
+
+
+def get_ocr_pool(workers):
+    """Returns the process pool shared by all OCR work in this process."""
+    global ocr_pool
+    with ocr_pool_lock:
+        if ocr_pool is None:
+            # Spawned workers do not inherit the threads (and their locks) of the API process.
+            ocr_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return ocr_pool
+
+
+def reset_ocr_pool():
+    """Drops a pool whose workers died, so the next OCR starts a fresh one."""
+    global ocr_pool
+    with ocr_pool_lock:
+        if ocr_pool is not None:
+            ocr_pool.shutdown(wait=False, cancel_futures=True)
+            ocr_pool = None
+
+
+def wait_for_ocr(future, timeout, poll_seconds=0.05):
+    """Returns the result of an OCR task, starting the `timeout` when the pool hands the task to a worker.
+    Tasks queued behind the pages and images of other files would otherwise time out before they start."""
+    while not future.running() and not future.done():
+        time.sleep(poll_seconds)
+    return future.result(timeout=timeout)
+
+
+def ocr_image_bytes(image_bytes, language, timeout):
+    """Runs Tesseract on an encoded image in a worker process. Returns the text and the OCR time."""
+    import pytesseract
+    from PIL import Image
+
+    start = time.perf_counter()
+    try:
+        image = Image.open(BytesIO(image_bytes))
+        text = pytesseract.image_to_string(image, lang=language, timeout=timeout)
+    except Exception as e:
+        # pytesseract errors cannot be unpickled in the parent and would break the whole pool.
+        raise RuntimeError(f"{type(e).__name__}: {e}") from None
+    return text, time.perf_counter() - start
 
 
 class PDFReader:
+    # Bump when the extraction output changes, so cached extractions are not reused.
+    version = "pdf-3"
+
     def __init__(self):
         self.file_path = None
+        self.language = os.getenv("OCR_LANGUAGE", "ita")
+        self.ocr_workers = int(os.getenv("OCR_WORKERS", os.cpu_count() or 1))
+        self.ocr_dpi = int(os.getenv("OCR_DPI", 300))
+        self.ocr_page_timeout = int(os.getenv("OCR_PAGE_TIMEOUT", 120))
+        # Pages with fewer characters of native text per square inch than this are OCRed.
+        self.text_density = float(os.getenv("OCR_TEXT_DENSITY", 1.0))
 
     def set_file_path(self, file_path):
         self.file_path = file_path
 
-    def extract_text(self):
-        """Extracts text from the PDF file using PyPDF2."""
-        text = ''
-        with open(self.file_path, 'rb') as f:
-            reader = PyPDF2.PdfReader(f)
-            for page in reader.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text
-        return text
-
-    def extract_images(self):
-        """Extracts images from each page of the PDF using PyMuPDF."""
-        images = []
-        with fitz.open(self.file_path) as pdf_document:
-            for page_number in range(pdf_document.page_count):
-                page = pdf_document[page_number]
-                image_list = page.get_images(full=True)
-
-                for img in image_list:
-                    xref = img[0]
-                    base_image = pdf_document.extract_image(xref)
-                    image_bytes = base_image["image"]
-
-                    # Convert bytes to a PIL Image object
-                    image = Image.open(BytesIO(image_bytes))
-                    images.append(image)
-        return images
-
-    def ocr_images(self, language='eng'):
-        """Extracts images and applies OCR to each image to retrieve text."""
-        pages_text = []
-        with fitz.open(self.file_path) as pdf_document:
-            for page_number in range(pdf_document.page_count):
-                page = pdf_document[page_number]
-                image_list = page.get_images(full=True)
-
-                for img in image_list:
-                    xref = img[0]
-                    base_image = pdf_document.extract_image(xref)
-                    image_bytes = base_image["image"]
-
-                    # Convert bytes to a PIL Image object
-                    image = Image.open(BytesIO(image_bytes))
-
-                    # Apply OCR to the image
-                    text = pytesseract.image_to_string(image, lang=language)
-                    pages_text.append(text)
-        return pages_text
+    def render_page(self, page, dpi=None):
+        """Renders a page to a grayscale PNG at the given DPI. Returns the PNG and the render time."""
+        import fitz
+
+        start = time.perf_counter()
+        pixmap = page.get_pixmap(dpi=dpi or self.ocr_dpi, colorspace=fitz.csGRAY)
+        return pixmap.tobytes("png"), time.perf_counter() - start
+
+    def extract_pages(self, language=None):
+        """Reads the PDF once, taking each page's native text or OCRing it when the text is too sparse.
+
+        Pages needing OCR are rendered here and recognised in the OCR pool while the following
+        pages are read. Results are yielded in page order, each a dict with the page number, its text,
+        a `method` of "text" or "ocr", the render and OCR times, and the error of a page whose OCR
+        failed or exceeded the per-page timeout, which yields an empty text.
+        """
+        import fitz
+
+        language = language or self.language
+        pending = deque()
+        try:
+            with fitz.open(self.file_path, filetype='pdf') as pdf_document:
+                for page_number in range(pdf_document.page_count):
+                    page = pdf_document[page_number]
+                    with EXTRACT_SECONDS.labels(extractor="pdf_text").time():
+                        text = page.get_text()
+                    area = abs(page.rect) / (72 * 72)
+                    if area and len(text.strip()) / area >= self.text_density:
+                        pending.append({
+                            "page": page_number + 1, "method": "text", "text": text,
+                            "render_seconds": None, "ocr_seconds": None, "error": None
+                        })
+                    else:
+                        image_bytes, render_time = self.render_page(page)
+                        EXTRACT_SECONDS.labels(extractor="pdf_render").observe(render_time)
+                        future = get_ocr_pool(self.ocr_workers).submit(
+                            ocr_image_bytes, image_bytes, language, self.ocr_page_timeout
+                        )
+                        pending.append((page_number, render_time, future))
+                    # Yield finished pages, waiting on OCR only when too many rendered pages are queued.
+                    while pending and (isinstance(pending[0], dict) or len(pending) >= self.ocr_workers * 2):
+                        yield self.resolve_page(pending.popleft())
+                while pending:
+                    yield self.resolve_page(pending.popleft())
+        except BrokenProcessPool:
+            reset_ocr_pool()
+            raise
+
+    def resolve_page(self, page):
+        if isinstance(page, dict):
+            return page
+        return self.collect_page(*page)
+
+    def collect_page(self, page_number, render_time, future):
+        result = {
+            "page": page_number + 1, "method": "ocr", "text": "",
+            "render_seconds": render_time, "ocr_seconds": None, "error": None
+        }
+        try:
+            # Tesseract is killed after the timeout. The pool hands one task more than it has workers,
+            # the margin covers that task waiting for a free worker.
+            text, ocr_time = wait_for_ocr(future, self.ocr_page_timeout * 2)
+            result.update(text=text, ocr_seconds=ocr_time)
+            EXTRACT_SECONDS.labels(extractor="ocr_page").observe(ocr_time)
+            logging.info(f"OCR of page {page_number + 1} of {self.file_path} took {ocr_time:.2f}s.")
+        except BrokenProcessPool:
+            raise
+        except TimeoutError:
+            future.cancel()
+            FAILURES.labels(stage="ocr").inc()
+            result["error"] = "timeout"
+            logging.warning(f"OCR of page {page_number + 1} of {self.file_path} timed out.")
+        except Exception as e:
+            FAILURES.labels(stage="ocr").inc()
+            result["error"] = str(e)
+            logging.error(f"OCR of page {page_number + 1} of {self.file_path} failed: {e}")
+        return result
@@ -0,0 +1,85 @@
+import binascii
+import hashlib
+import logging
+import os
+import tempfile
+
+
+class AttachmentStore:
+    """Content-addressed attachment storage: each distinct file is stored once, named by its sha256."""
+
+    def __init__(self, root="attachments"):
+        self.root = root
+        self.chunk_size = 64 * 1024
+        os.makedirs(os.path.join(self.root, "sha256"), exist_ok=True)
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, "sha256", digest[:2], digest)
+
+    def path(self, attachment):
+        """Returns the file path of an attachment entry, including entries saved before hashing."""
+        if attachment.get("sha256"):
+            return self.blob_path(attachment["sha256"])
+        return os.path.join(self.root, attachment["file"])
+
+    def hash_file(self, path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(self.chunk_size), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def decode_chunks(self, payload, encoding=None):
+        """Yields the decoded payload in chunks, never holding a full decoded copy in memory."""
+        if isinstance(payload, str):
+            payload = payload.encode("ascii", errors="replace")
+        encoding = (encoding or "").lower()
+        if encoding not in ("base64", "quoted-printable"):
+            for i in range(0, len(payload), self.chunk_size):
+                yield payload[i:i + self.chunk_size]
+            return
+
+        pending = b""
+        start = 0
+        while start < len(payload):
+            # Split on line boundaries so soft line breaks and base64 groups are not cut in half.
+            end = payload.find(b"\n", start + self.chunk_size)
+            end = len(payload) if end == -1 else end + 1
+            chunk = payload[start:end]
+            start = end
+            if encoding == "quoted-printable":
+                yield binascii.a2b_qp(chunk)
+                continue
+            data = pending + b"".join(chunk.split())
+            usable = len(data) - len(data) % 4
+            pending = data[usable:]
+            if usable:
+                yield binascii.a2b_base64(data[:usable])
+        if pending:
+            yield binascii.a2b_base64(pending + b"=" * (-len(pending) % 4))
+
+    def save(self, payload, filename, encoding=None):
+        """Decodes and writes a payload atomically, returning its entry for the `attachments` JSON."""
+        digest = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                for chunk in self.decode_chunks(payload, encoding):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    file.write(chunk)
+            sha256 = digest.hexdigest()
+            path = self.blob_path(sha256)
+            if os.path.exists(path):
+                os.remove(temp_path)
+                logging.info(f"Attachment already stored: {filename} ({sha256})")
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+                logging.info(f"Attachment saved: {filename} ({sha256})")
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return {"file": filename, "sha256": sha256, "size": size}
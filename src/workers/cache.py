@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from database import DatabaseManager
+
+
+class LLMCache:
+    """LLM responses keyed by model, prompt and options, in an in-process LRU in front of Postgres."""
+
+    def __init__(self, db_manager: DatabaseManager):
+        self.db_manager = db_manager
+        self.ttl = int(os.getenv("LLM_CACHE_TTL", 30 * 24 * 3600))
+        self.max_entries = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 10000))
+        self.memory_size = int(os.getenv("LLM_CACHE_MEMORY_SIZE", 256))
+        self.prune_every = 100
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "db_hits": 0, "misses": 0, "writes": 0, "saved_seconds": 0.0}
+
+    @staticmethod
+    def make_key(model, prompt, options=None):
+        payload = json.dumps({"model": model, "prompt": prompt, "options": options or {}}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _count(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def get(self, key):
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if time.time() - entry["created_at"] < self.ttl:
+                    self.memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    self.counters["saved_seconds"] += entry["duration"] or 0
+                    return entry["response"]
+                del self.memory[key]
+
+        row = self.db_manager.read_llm_cache(key, self.ttl)
+        if row is None:
+            self._count("misses")
+            return None
+        self._count("db_hits")
+        self._count("saved_seconds", row.duration or 0)
+        self._remember(key, row.response, row.duration, row.created_at.timestamp())
+        return row.response
+
+    def put(self, key, model, response, duration=None):
+        self._remember(key, response, duration, time.time())
+        self.db_manager.write_llm_cache(key, model, response, duration)
+        self._count("writes")
+        if self.counters["writes"] % self.prune_every == 0:
+            self.db_manager.prune_llm_cache(self.ttl, self.max_entries)
+
+    def _remember(self, key, response, duration, created_at):
+        with self.lock:
+            self.memory[key] = {"response": response, "duration": duration, "created_at": created_at}
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_size:
+                self.memory.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["memory_entries"] = len(self.memory)
+        lookups = stats["memory_hits"] + stats["db_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["db_hits"]) / lookups if lookups else 0.0
+        return stats
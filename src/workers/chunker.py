@@ -0,0 +1,55 @@
+import math
+import os
+import re
+
+# Rough average for Italian text with the gemma2 tokenizer, good enough to stay within the context.
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+class Chunker:
+    """Splits long text into overlapping chunks that fit a token budget, preferring paragraph breaks."""
+
+    def __init__(self):
+        self.chunk_tokens = int(os.getenv("SUMMARY_CHUNK_TOKENS", 1500))
+        self.overlap_tokens = int(os.getenv("SUMMARY_CHUNK_OVERLAP", 100))
+
+    def fits(self, text):
+        return estimate_tokens(text) <= self.chunk_tokens
+
+    def split(self, text):
+        # Words keep their trailing whitespace, so newlines survive and chunks join back losslessly.
+        pieces = re.findall(r"\S+\s*", text)
+        size = self.chunk_tokens * CHARS_PER_TOKEN
+        pieces = [piece[i:i + size] for piece in pieces for i in range(0, len(piece), size)]
+        chunks = []
+        start = 0
+        while start < len(pieces):
+            end = start
+            tokens = 0
+            last_break = None
+            while end < len(pieces) and (tokens + estimate_tokens(pieces[end]) <= self.chunk_tokens or end == start):
+                tokens += estimate_tokens(pieces[end])
+                end += 1
+                if "\n" in pieces[end - 1]:
+                    last_break = end
+            # Cut at the last line break if it keeps the chunk at least half full.
+            if end < len(pieces) and last_break and last_break - start > (end - start) // 2:
+                end = last_break
+            chunks.append("".join(pieces[start:end]).strip())
+            if end >= len(pieces):
+                break
+            start = max(self.overlap_start(pieces, start, end), start + 1)
+        return chunks
+
+    def overlap_start(self, pieces, start, end):
+        """Returns where the next chunk starts so it repeats the last `overlap_tokens` of this one."""
+        tokens = 0
+        position = end
+        while position > start and tokens + estimate_tokens(pieces[position - 1]) <= self.overlap_tokens:
+            position -= 1
+            tokens += estimate_tokens(pieces[position])
+        return position
@@ -0,0 +1,71 @@
+import logging
+import os
+from itertools import groupby
+
+from database import DatabaseManager, OUTBOX_CHANNEL, timeline_entry
+from workers.sender import Sender
+
+
+class Dispatcher:
+    """Drains the outbox in batches, sending each rendered email to the recipients still waiting for it."""
+
+    def __init__(self, db_manager: DatabaseManager, sender: Sender):
+        self.db_manager = db_manager
+        self.sender = sender
+        self.batch_size = int(os.getenv("OUTBOX_BATCH_SIZE", 20))
+
+    def rendered_message(self, email_id):
+        """Returns the stored MIME message of an email, rendering and storing it if needed."""
+        rendered = self.db_manager.read_rendered_email(email_id)
+        if rendered is not None:
+            return rendered.mime
+        log = self.db_manager.read_email_log(email_id)
+        if log is None:
+            return None
+        rendered = self.sender.render(log)
+        self.db_manager.save_rendered_email(email_id, rendered)
+        return rendered["mime"]
+
+    def dispatch(self):
+        """Delivers one batch of due outbox rows. Returns the number of rows handled."""
+        deliveries = self.db_manager.claim_outbox(self.batch_size)
+        deliveries.sort(key=lambda delivery: delivery.email_id)
+        for email_id, group in groupby(deliveries, key=lambda delivery: delivery.email_id):
+            group = list(group)
+            mime = self.rendered_message(email_id)
+            if mime is None:
+                for delivery in group:
+                    self.db_manager.fail_outbox(delivery.id, "Log not found.")
+                continue
+            responses = self.sender.deliver(email_id, mime, [delivery.recipient for delivery in group])
+            self.db_manager.complete_outbox([
+                delivery.id for delivery, response in zip(group, responses) if response["success"]
+            ])
+            for delivery, response in zip(group, responses):
+                if not response["success"]:
+                    self.db_manager.fail_outbox(delivery.id, response["error"])
+            self.db_manager.add_timeline(email_id, [
+                timeline_entry(
+                    "send", response["started_at"], response["ended_at"], label=response["recipient"],
+                    size=len(mime), success=response["success"], error=response["error"],
+                    attempt=delivery.attempts
+                )
+                for delivery, response in zip(group, responses)
+            ])
+            logging.info(f"Delivered email {email_id} to {sum(r['success'] for r in responses)}/{len(group)} recipients.")
+        return len(deliveries)
+
+    def run(self, interval_seconds=60):
+        """Drain the outbox, waking up on NOTIFY or at least every `interval_seconds` for retries."""
+        logging.info(f"Outbox dispatcher started, checking for deliveries at least every {interval_seconds} seconds.")
+        listener = self.db_manager.listen(OUTBOX_CHANNEL)
+        try:
+            while True:
+                try:
+                    while self.dispatch():
+                        continue
+                except Exception as e:
+                    logging.error(f"Error while dispatching the outbox: {e}")
+                listener.wait(interval_seconds)
+        finally:
+            listener.close()
@@ -1,39 +1,137 @@
+import asyncio
 import logging
 import os
 
-from ollama import Client
+from ollama import AsyncClient
+
+from database import now, timeline_entry
+from metrics import FAILURES, LLM_PROMPT_CHARS, LLM_REQUEST_SECONDS, LLM_RESPONSE_CHARS
+from workers.cache import LLMCache
+from workers.chunker import Chunker
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 
 endpoint = os.getenv("OLLAMA_HOST", "http://ollama:11434")
 
 
+class AsyncSession:
+    """Async Ollama client bounding the number of concurrent requests. Bound to one event loop.
+    Every request made through it is recorded in `timeline`."""
+
+    def __init__(self, concurrency, use_cache=True):
+        self.client = AsyncClient(host=endpoint)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.use_cache = use_cache
+        self.timeline = []
+
+
 class Operator:
-    def __init__(self):
-        self.client = Client(host=endpoint)
+    def __init__(self, cache: LLMCache = None):
         self.model = "gemma2:latest"
+        self.cache = cache
+        self.chunker = Chunker()
+        # Match the server's OLLAMA_NUM_PARALLEL, extra requests would only queue up on the server.
+        self.concurrency = int(os.getenv("OLLAMA_NUM_PARALLEL", 4))
 
-    def ask(self, question):
+    def session(self, use_cache=True):
+        return AsyncSession(self.concurrency, use_cache)
+
+    def cache_key(self, question):
+        return LLMCache.make_key(self.model, question)
+
+    def cache_response(self, key, response):
+        content = response["message"]["content"]
+        LLM_RESPONSE_CHARS.observe(len(content or ""))
+        if self.cache and content:
+            # Ollama reports durations in nanoseconds.
+            self.cache.put(key, self.model, content, response.get("total_duration", 0) / 1e9)
+        return content
+
+    async def ask_async(self, question, session: AsyncSession, label=None):
+        """Asks the model a question within the session, recording the request in its timeline under `label`."""
+        started_at = now()
+        detail = {"cached": False}
+        content = None
         try:
+            key = self.cache_key(question)
+            if self.cache and session.use_cache:
+                content = await asyncio.to_thread(self.cache.get, key)
+                if content is not None:
+                    detail["cached"] = True
+                    return content
             messages = [{'role': 'user', 'content': question}]
-            response = self.client.chat(
-                model=self.model,
-                messages=messages
-            )
-            return response["message"]["content"]
+            LLM_PROMPT_CHARS.observe(len(question))
+            async with session.semaphore:
+                detail["queued_seconds"] = round((now() - started_at).total_seconds(), 3)
+                # Timed inside the semaphore, so waiting for a free slot does not count as latency.
+                with LLM_REQUEST_SECONDS.time():
+                    response = await session.client.chat(
+                        model=self.model,
+                        messages=messages
+                    )
+            content = await asyncio.to_thread(self.cache_response, key, response)
+            return content
         except Exception as e:
+            FAILURES.labels(stage="llm").inc()
             logging.error(f"Error asking question: {e}, {endpoint}")
+            detail["error"] = str(e)
             return None
+        finally:
+            session.timeline.append(timeline_entry(
+                "llm", started_at, now(), label=label, size=len(question),
+                response_chars=len(content) if content is not None else None, **detail
+            ))
 
-    def summarise_documents(self, attachments):
-        summaries = []
-        for document in attachments:
-            if document["text"]:
-                logging.info(f"Processing document: {document['file']}")
-                prompt = f"Genera un riassunto in italiano del documento, o circolare {document['file']}: {document['text']}"
-                summary = self.ask(prompt)
-                summaries.append({
-                    "file": document["file"],
-                    "text": summary
-                })
-        return summaries
+    @staticmethod
+    def summary_prompt(document):
+        return f"Genera un riassunto in italiano del documento, o circolare {document['file']}: {document['text']}"
+
+    @staticmethod
+    def document_text(document):
+        # Older OCR results are stored as a list of page texts.
+        text = document["text"]
+        return "\n".join(text) if isinstance(text, list) else text
+
+    async def summarise_documents_async(self, attachments, session: AsyncSession):
+        """Summarises all documents concurrently, within the session's concurrency limit."""
+        documents = [
+            {"file": document["file"], "text": self.document_text(document)}
+            for document in attachments if document["text"]
+        ]
+        summaries = await asyncio.gather(
+            *(self.summarise_document_async(document, session) for document in documents)
+        )
+        return [
+            {"file": document["file"], "text": summary}
+            for document, summary in zip(documents, summaries)
+        ]
+
+    async def summarise_document_async(self, document, session: AsyncSession, depth=0):
+        """Summarises a document in one prompt, or map-reduce style when it exceeds the chunk size."""
+        logging.info(f"Processing document: {document['file']}")
+        if self.chunker.fits(document["text"]):
+            return await self.ask_async(self.summary_prompt(document), session, document["file"])
+
+        chunks = self.chunker.split(document["text"])
+        logging.info(f"Summarising {document['file']} in {len(chunks)} chunks.")
+        partials = await asyncio.gather(*(
+            self.ask_async(
+                f"Riassumi in italiano la parte {i} di {len(chunks)} del documento, o circolare "
+                f"{document['file']}: {chunk}",
+                session, f"{document['file']} ({i}/{len(chunks)})"
+            )
+            for i, chunk in enumerate(chunks, start=1)
+        ))
+        if any(partial is None for partial in partials):
+            return None
+        merged = "\n\n".join(partials)
+        if not self.chunker.fits(merged) and depth < 2:
+            # The partial summaries are still too long, reduce them again.
+            return await self.summarise_document_async(
+                {"file": document["file"], "text": merged}, session, depth + 1
+            )
+        return await self.ask_async(
+            f"Unisci i seguenti riassunti parziali del documento, o circolare {document['file']} "
+            f"in un unico riassunto in italiano: {merged}",
+            session, f"{document['file']} (merge)"
+        )
@@ -1,24 +1,86 @@
 import logging
 import os
+import queue
 import smtplib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
 import markdown
-from database import EmailLog
+from database import EmailLog, now
+from metrics import FAILURES, SMTP_SEND_SECONDS
+
+
+class SMTPPool:
+    """Keeps up to `size` authenticated SMTP connections alive and hands them out one at a time."""
+
+    def __init__(self, connect, size):
+        self.connect = connect
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+        if not create:
+            return self.idle.get()
+        try:
+            return self.connect()
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+
+    def release(self, server):
+        self.idle.put(server)
+
+    def discard(self, server):
+        with self.lock:
+            self.created -= 1
+        try:
+            server.close()
+        except Exception as e:
+            logging.warning(f"Error closing SMTP connection: {e}")
+
+    def close(self):
+        while True:
+            try:
+                server = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                server.quit()
+            except Exception as e:
+                logging.warning(f"Error closing SMTP connection: {e}")
+            with self.lock:
+                self.created -= 1
 
 
 class Sender:
     def __init__(self):
-        self.smtp_server = os.getenv("IMAP_SERVER")
-        self.port = int(os.getenv("SMTP_PORT", 465))
+        self.smtp_server = os.getenv("SMTP_SERVER") or os.getenv("IMAP_SERVER")
+        self.smtp_ssl = os.getenv("SMTP_SSL", "true").lower() == "true"
+        self.port = int(os.getenv("SMTP_PORT", 465 if self.smtp_ssl else 587))
         self.email_account = os.getenv("EMAIL_ACCOUNT")
         self.password = os.getenv("PASSWORD")
         self.recipients = os.getenv("RECIPIENTS").split(",")
+        self.pool = SMTPPool(self.connect_to_smtp, int(os.getenv("SMTP_POOL_SIZE", 3)))
+        # Recipients per message. Above 1, one copy goes to many RCPT TO with undisclosed recipients.
+        self.rcpt_batch = int(os.getenv("SMTP_RCPT_BATCH", 1))
 
     def connect_to_smtp(self):
         try:
-            server = smtplib.SMTP_SSL(self.smtp_server, self.port)
+            smtp = smtplib.SMTP_SSL if self.smtp_ssl else smtplib.SMTP
+            server = smtp(self.smtp_server, self.port)
             server.login(self.email_account, self.password)
             logging.info("Connected to SMTP server successfully.")
             return server
@@ -30,43 +92,114 @@ class Sender:
     def markdown_to_html(text):
         return markdown.markdown(text)
 
-    def send_email(self, mail_id, to_address, subject, body):
-        server = None
-        try:
-            server = self.connect_to_smtp()
-            html_body = self.markdown_to_html(body)
+    def sendmail(self, to_addresses, message):
+        """Sends a message over a pooled connection, reconnecting once if the server dropped it.
+        Returns the recipients the server refused, like smtplib's sendmail."""
+        for attempt in range(2):
+            server = self.pool.acquire()
+            try:
+                with SMTP_SEND_SECONDS.time():
+                    refused = server.sendmail(self.email_account, to_addresses, message)
+            except smtplib.SMTPServerDisconnected:
+                self.pool.discard(server)
+                if attempt:
+                    raise
+                logging.info("SMTP connection was closed by the server. Reconnecting...")
+                continue
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+                # The server answered, so the connection is still usable.
+                self.pool.release(server)
+                raise
+            except Exception:
+                self.pool.discard(server)
+                raise
+            self.pool.release(server)
+            return refused
+
+    def render_message(self, subject, body) -> dict:
+        """Builds the plain text, HTML and serialised MIME message once, without a To header."""
+        html_body = self.markdown_to_html(body)
+
+        message = MIMEMultipart("alternative")
+        message["From"] = self.email_account
+        message["Subject"] = subject
 
-            message = MIMEMultipart("alternative")
-            message["From"] = self.email_account
-            message["To"] = to_address
-            message["Subject"] = subject
+        message.attach(MIMEText(body, "plain"))
+        message.attach(MIMEText(html_body, "html"))
+        return {"subject": subject, "text": body, "html": html_body, "mime": message.as_bytes()}
 
-            message.attach(MIMEText(body, "plain"))
-            message.attach(MIMEText(html_body, "html"))
+    def render(self, log: EmailLog) -> dict:
+        email = self.email_transformer(log)
+        return self.render_message(email.subject, email.body)
 
-            server.sendmail(self.email_account, to_address, message.as_string())
+    @staticmethod
+    def address(mime: bytes, to_address) -> bytes:
+        """Prepends the To header to a rendered message, the only part that differs per recipient."""
+        return f"To: {to_address}\n".encode("utf-8") + mime
+
+    def send_rendered(self, mail_id, to_address, mime: bytes):
+        started_at = now()
+        try:
+            self.sendmail(to_address, self.address(mime, to_address))
             logging.info(f"Email sent to {to_address}")
-            return {"id": mail_id, "recipient": to_address, "success": True, "error": None}
+            return {"id": mail_id, "recipient": to_address, "success": True, "error": None,
+                    "started_at": started_at, "ended_at": now()}
 
         except Exception as e:
+            FAILURES.labels(stage="send").inc()
             logging.error(f"Error sending email: {e}")
-            return {"id": mail_id, "recipient": to_address, "success": False, "error": str(e)}
+            return {"id": mail_id, "recipient": to_address, "success": False, "error": str(e),
+                    "started_at": started_at, "ended_at": now()}
 
-        finally:
-            if server:
-                server.quit()
+    def send_batch(self, mail_id, to_addresses, mime: bytes):
+        """Sends one copy of the message to several recipients at once."""
+        started_at = now()
+        try:
+            refused = self.sendmail(to_addresses, self.address(mime, "undisclosed-recipients:;"))
+            logging.info(f"Email sent to {len(to_addresses) - len(refused)} recipients")
+            ended_at = now()
+            return [
+                {
+                    "id": mail_id,
+                    "recipient": to_address,
+                    "success": to_address not in refused,
+                    "error": str(refused[to_address]) if to_address in refused else None,
+                    "started_at": started_at,
+                    "ended_at": ended_at
+                }
+                for to_address in to_addresses
+            ]
+
+        except Exception as e:
+            FAILURES.labels(stage="send").inc()
+            logging.error(f"Error sending email: {e}")
+            ended_at = now()
+            return [
+                {"id": mail_id, "recipient": to_address, "success": False, "error": str(e),
+                 "started_at": started_at, "ended_at": ended_at}
+                for to_address in to_addresses
+            ]
 
     @staticmethod
     def email_transformer(email: EmailLog) -> EmailLog:
-        email.subject = f"Riassunto Circolare: {email.subject}"
-        summarised_body = "\n".join([f"Allegato {i + 1}: {summary['text']}" for i, summary in enumerate(email.summary)])
-        email.body = email.body + "\n\n" + summarised_body
-        return email
-
-    def send_emails(self, log: EmailLog) -> list[dict]:
-        log = self.email_transformer(log)
-        responses = []
-        for recipient in self.recipients:
-            response = self.send_email(log.id, recipient, log.subject, log.body)
-            responses.append(response)
-        return responses
+        """Returns a copy of the email with the forwarding subject and the summaries appended."""
+        summarised_body = "\n".join([
+            f"Allegato {i + 1}: {summary['text']}" for i, summary in enumerate(email.summary or [])
+        ])
+        return EmailLog(
+            id=email.id,
+            subject=f"Riassunto Circolare: {email.subject}",
+            sender=email.sender,
+            body=(email.body or "") + "\n\n" + summarised_body,
+            summary=email.summary,
+            received_at=email.received_at
+        )
+
+    def deliver(self, mail_id, mime: bytes, recipients) -> list[dict]:
+        """Sends a rendered message to the recipients in parallel over the connection pool."""
+        with ThreadPoolExecutor(max_workers=self.pool.size) as executor:
+            if self.rcpt_batch > 1:
+                batches = [recipients[i:i + self.rcpt_batch] for i in range(0, len(recipients), self.rcpt_batch)]
+                results = executor.map(lambda batch: self.send_batch(mail_id, batch, mime), batches)
+                return [response for responses in results for response in responses]
+            return list(executor.map(lambda recipient: self.send_rendered(mail_id, recipient, mime), recipients))
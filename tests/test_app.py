@@ -0,0 +1,69 @@
+import base64
+import os
+from datetime import datetime, timezone
+
+import pytest
+from fastapi import HTTPException, Request
+
+
+@pytest.fixture(scope="module")
+def app(tmp_path_factory):
+    # Importing the app creates the attachment directory in the working directory.
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("app"))
+    try:
+        import app
+    finally:
+        os.chdir(cwd)
+    return app
+
+
+def request(if_none_match=None):
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+    return Request({"type": "http", "method": "GET", "path": "/logs", "headers": headers})
+
+
+def test_cursor_round_trip(app):
+    received_at = datetime(2026, 3, 1, 9, 30, 15, 123456, tzinfo=timezone.utc)
+
+    cursor = app.encode_cursor({"received_at": received_at, "id": 42})
+
+    assert app.decode_cursor(cursor) == (received_at, 42)
+
+
+@pytest.mark.parametrize("cursor", [
+    "not a cursor",
+    "YWJj",
+    base64.urlsafe_b64encode(b"2026-03-01T09:30:00|x").decode(),
+    base64.urlsafe_b64encode(b"ieri|42").decode(),
+    base64.urlsafe_b64encode(b"2026-03-01T09:30:00|42|7").decode(),
+    base64.urlsafe_b64encode(b"\xff\xfe|42").decode(),
+])
+def test_malformed_cursors_are_rejected(app, cursor):
+    with pytest.raises(HTTPException) as error:
+        app.decode_cursor(cursor)
+
+    assert error.value.status_code == 400
+
+
+def test_etag_answers_not_modified_for_the_same_content(app):
+    content = {"items": [{"id": 1, "received_at": datetime(2026, 3, 1, tzinfo=timezone.utc)}], "next_cursor": None}
+
+    first = app.etag_response(request(), content)
+    etag = first.headers["etag"]
+    again = app.etag_response(request(etag), content)
+    listed = app.etag_response(request(f'"other", {etag}'), content)
+
+    assert first.status_code == 200 and first.body
+    assert again.status_code == 304 and again.body == b""
+    assert again.headers["etag"] == etag
+    assert listed.status_code == 304
+
+
+def test_etag_changes_with_the_content(app):
+    etag = app.etag_response(request(), {"items": [], "next_cursor": None}).headers["etag"]
+
+    changed = app.etag_response(request(etag), {"items": [{"id": 1}], "next_cursor": None})
+
+    assert changed.status_code == 200
+    assert changed.headers["etag"] != etag
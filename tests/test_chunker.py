@@ -0,0 +1,57 @@
+import pytest
+
+from workers.chunker import Chunker, estimate_tokens
+
+
+@pytest.fixture
+def chunker(monkeypatch):
+    monkeypatch.setenv("SUMMARY_CHUNK_TOKENS", "20")
+    monkeypatch.setenv("SUMMARY_CHUNK_OVERLAP", "5")
+    return Chunker()
+
+
+def words(count):
+    # Five characters with the space, two tokens each.
+    return [f"w{i:03}" for i in range(count)]
+
+
+def test_short_text_is_one_chunk(chunker):
+    assert chunker.fits("Breve circolare.")
+    assert chunker.split("  Breve circolare.\n") == ["Breve circolare."]
+
+
+def test_chunks_stay_within_the_budget_and_cover_the_text(chunker):
+    text = " ".join(words(200))
+    chunks = chunker.split(text)
+
+    assert len(chunks) > 1
+    assert all(estimate_tokens(chunk) <= chunker.chunk_tokens for chunk in chunks)
+    assert {word for chunk in chunks for word in chunk.split()} == set(words(200))
+
+
+def test_consecutive_chunks_overlap(chunker):
+    chunks = chunker.split(" ".join(words(200)))
+
+    for previous, following in zip(chunks, chunks[1:]):
+        previous_words, following_words = previous.split(), following.split()
+        overlap = previous_words[previous_words.index(following_words[0]):]
+        assert overlap == following_words[:len(overlap)]
+        assert 0 < estimate_tokens(" ".join(overlap)) <= chunker.overlap_tokens
+
+
+def test_chunks_are_cut_at_line_breaks(chunker):
+    lines = [" ".join(words(60)[i:i + 3]) for i in range(0, 60, 3)]
+    chunks = chunker.split("\n".join(lines))
+
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert chunk.split("\n")[-1] in lines
+
+
+def test_giant_words_are_split_and_make_progress(chunker):
+    word = "".join(chr(ord("a") + i % 26) for i in range(1000))
+    chunks = chunker.split(f"inizio {word} fine")
+
+    assert all(estimate_tokens(chunk) <= chunker.chunk_tokens for chunk in chunks)
+    assert word in "".join(chunk.replace(" ", "") for chunk in chunks)
+    assert chunks[0].startswith("inizio") and chunks[-1].endswith("fine")
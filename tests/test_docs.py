@@ -0,0 +1,46 @@
+from docx import Document
+
+from readers.docs import iter_docx_blocks
+
+
+def test_paragraphs_and_tables_in_document_order():
+    document = Document()
+    document.add_paragraph("Orario delle lezioni")
+    table = document.add_table(rows=2, cols=2)
+    table.cell(0, 0).text = "Classe"
+    table.cell(0, 1).text = "Aula"
+    table.cell(1, 0).text = "1A"
+    table.cell(1, 1).text = "12"
+    document.add_paragraph("Il dirigente")
+
+    assert list(iter_docx_blocks(document)) == [
+        "Orario delle lezioni", "Classe | Aula", "1A | 12", "Il dirigente"
+    ]
+
+
+def test_adjacent_cells_with_the_same_text_are_kept():
+    document = Document()
+    table = document.add_table(rows=1, cols=3)
+    for cell, text in zip(table.rows[0].cells, ["1A", "Sì", "Sì"]):
+        cell.text = text
+
+    assert list(iter_docx_blocks(document)) == ["1A | Sì | Sì"]
+
+
+def test_merged_cells_are_read_once():
+    document = Document()
+    table = document.add_table(rows=2, cols=3)
+    table.cell(0, 0).merge(table.cell(0, 2)).text = "Uscita didattica"
+    for cell, text in zip(table.rows[1].cells, ["1A", "Sì", "Sì"]):
+        cell.text = text
+
+    assert list(iter_docx_blocks(document)) == ["Uscita didattica", "1A | Sì | Sì"]
+
+
+def test_empty_cells_are_skipped():
+    document = Document()
+    table = document.add_table(rows=1, cols=3)
+    table.cell(0, 0).text = "1A"
+    table.cell(0, 2).text = "Sì"
+
+    assert list(iter_docx_blocks(document)) == ["1A | Sì"]
@@ -0,0 +1,72 @@
+import base64
+import hashlib
+import os
+import quopri
+
+import pytest
+
+from storage import AttachmentStore
+
+CONTENT = "".join(f"Riga {i}: gita d'istruzione, uscita didattica. àèìòù €\n" for i in range(200)).encode("utf-8")
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = AttachmentStore(str(tmp_path))
+    # Small chunks, so the payloads are decoded in many pieces.
+    store.chunk_size = 100
+    return store
+
+
+def stored_files(store):
+    return sorted(
+        os.path.relpath(os.path.join(directory, name), store.root)
+        for directory, _, names in os.walk(store.root) for name in names
+    )
+
+
+def read(store, entry):
+    with open(store.path(entry), "rb") as file:
+        return file.read()
+
+
+@pytest.mark.parametrize("payload, encoding", [
+    (base64.encodebytes(CONTENT).decode("ascii"), "base64"),
+    (base64.encodebytes(CONTENT).decode("ascii").replace("\n", "\r\n"), "Base64"),
+    (quopri.encodestring(CONTENT).decode("ascii"), "quoted-printable"),
+    (CONTENT, "8bit"),
+    (CONTENT, None),
+])
+def test_payloads_are_decoded(store, payload, encoding):
+    entry = store.save(payload, "circolare.txt", encoding)
+
+    assert entry == {"file": "circolare.txt", "sha256": hashlib.sha256(CONTENT).hexdigest(), "size": len(CONTENT)}
+    assert read(store, entry) == CONTENT
+
+
+def test_unpadded_base64_is_decoded(store):
+    payload = base64.b64encode(b"ciao!").rstrip(b"=").decode("ascii")
+
+    assert read(store, store.save(payload, "a.txt", "base64")) == b"ciao!"
+
+
+def test_files_are_stored_by_content(store):
+    digest = hashlib.sha256(CONTENT).hexdigest()
+
+    first = store.save(base64.encodebytes(CONTENT).decode("ascii"), "circolare.pdf", "base64")
+    second = store.save(CONTENT, "copia.pdf")
+
+    assert first["sha256"] == second["sha256"] == digest
+    assert store.path(first) == store.path(second) == os.path.join(store.root, "sha256", digest[:2], digest)
+    # Stored once, and no temporary file is left behind.
+    assert stored_files(store) == [os.path.join("sha256", digest[:2], digest)]
+
+
+def test_entries_saved_before_hashing_keep_their_path(store):
+    assert store.path({"file": "vecchio.pdf"}) == os.path.join(store.root, "vecchio.pdf")
+
+
+def test_hash_file_matches_the_stored_digest(store):
+    entry = store.save(CONTENT, "circolare.txt")
+
+    assert store.hash_file(store.path(entry)) == entry["sha256"]